@@ -0,0 +1,142 @@
+# encoding: utf-8
+"""Benchmarks for the script filter hot path
+
+Usage:
+    python3 benchmark.py filter [<aliases>] [<query>]
+    python3 benchmark.py imports [<runs>]
+
+filter - compares the number of item scans (search field lookups) and
+the time one keystroke costs when every query variant is filtered
+separately, as filter.main used to, against the single pass planner.
+
+imports - times importing filter.py with ``python3 -X importtime`` and
+fails if the best of <runs> takes longer than IMPORT_BUDGET milliseconds,
+or if any of the modules filter.py defers gets imported.
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+# Workflow() needs somewhere to keep its cache and settings
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault('alfred_workflow_bundleid', 'net.schwark.alfred-simplelogin.benchmark')
+os.environ.setdefault('alfred_workflow_cache', _tmp)
+os.environ.setdefault('alfred_workflow_data', _tmp)
+
+from workflow import Workflow
+import filter as sl_filter
+from search import add_search_fields, fields_getter, build_index
+
+# milliseconds importing filter.py may take
+IMPORT_BUDGET = 40
+# modules only some keystrokes need, which filter.py must not import up front
+DEFERRED_MODULES = ['argparse', 'subprocess', 'plistlib', 'uuid', 'tempfile',
+                    'ssl', 'http.client', 'workflow.web', 'workflow.update']
+
+
+def make_aliases(count):
+    senders = ['amazon', 'paypal', 'github', 'netflix', 'ebay', 'spotify']
+    aliases = []
+    for i in range(count):
+        alias = {
+            'id': i,
+            'email': 'random.word'+str(i)+'@simplelogin.com',
+            'enabled': True,
+            'latest_activity': {'contact': {'email': 'info@'+senders[i % len(senders)]+'.com'}},
+        }
+        alias['_display_name'] = alias['email']
+        aliases.append(add_search_fields(alias, 'alias'))
+    return aliases
+
+def counted(func, counter):
+    def wrapper(item):
+        counter[0] += 1
+        return func(item)
+    return wrapper
+
+def legacy_filter(wf, query, items, key):
+    """Every filter call filter.main used to make for one collection: three
+    query variants, twice over for command extraction, then the final query"""
+    words = query.split()
+    for _ in range(2):
+        sl_filter.get_filtered_items(wf, query, items, key)
+        if len(words) > 1:
+            sl_filter.get_filtered_items(wf, ' '.join(words[0:-1]), items, key)
+        if len(words) > 2:
+            sl_filter.get_filtered_items(wf, ' '.join(words[0:-2]), items, key)
+    return sl_filter.get_filtered_items(wf, query, items, key)
+
+def planned_filter(wf, query, items, key, index=None):
+    return sl_filter.get_planned_items(wf, query, items, key, index)[0]
+
+def bench_filter(count=3000, query='word12 amazon'):
+    wf = Workflow()
+    sl_filter.log = wf.logger
+    aliases = make_aliases(count)
+    index = build_index(aliases, fields_getter('alias'))
+    runs = [
+        ('per-variant', lambda key: legacy_filter(wf, query, aliases, key)),
+        ('planned', lambda key: planned_filter(wf, query, aliases, key)),
+        ('planned+index', lambda key: planned_filter(wf, query, aliases, key, index)),
+    ]
+    print('query '+repr(query)+' over '+str(count)+' aliases')
+    results = []
+    for name, run in runs:
+        scans = [0]
+        start = time.time()
+        result = run(counted(fields_getter('alias'), scans))
+        elapsed = time.time() - start
+        results.append(result)
+        print('  %-14s %7d scans %8.1f ms %4d results' % (name, scans[0], elapsed*1000, len(result)))
+    if any(result != results[0] for result in results):
+        print('  results differ!')
+        return 1
+    return 0
+
+def import_times():
+    """Cumulative microseconds per module of one fresh ``import filter``"""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import filter'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def bench_imports(runs=10):
+    samples = [import_times() for _ in range(runs)]
+    best = min(samples, key=lambda x: x['filter'])
+    print('import filter: best %.1f ms of %d runs (budget %d ms)' % (best['filter']/1000.0, runs, IMPORT_BUDGET))
+    top = sorted((x for x in best.items() if '.' not in x[0] and x[0] != 'filter'), key=lambda x: -x[1])[0:8]
+    for name, us in top:
+        print('  %-20s %7.1f ms' % (name, us/1000.0))
+    failed = 0
+    deferred = [name for name in DEFERRED_MODULES if name in best]
+    if deferred:
+        print('  imported up front: '+', '.join(deferred))
+        failed = 1
+    if best['filter'] > IMPORT_BUDGET*1000:
+        print('  over budget!')
+        failed = 1
+    return failed
+
+def main(argv):
+    if not argv or argv[0] not in ('filter', 'imports'):
+        print(__doc__)
+        return 1
+    if 'imports' == argv[0]:
+        return bench_imports(int(argv[1]) if len(argv) > 1 else 10)
+    count = int(argv[1]) if len(argv) > 1 else 3000
+    query = ' '.join(argv[2:]) if len(argv) > 2 else 'word12 amazon'
+    return bench_filter(count, query)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,17 +2,28 @@
 
 import sys
 import re
+import time
 import argparse
 from os import listdir, environ
-from simplelogin import SimpleLogin
+from simplelogin import SimpleLogin, SimpleLoginError, DEFAULT_CONCURRENCY
 from workflow.workflow import MATCH_ATOM, MATCH_STARTSWITH, MATCH_SUBSTRING, MATCH_ALL, MATCH_INITIALS, MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN
 from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_ERROR, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, web, PasswordNotFound
+import daemon
+from workflow.background import run_in_background
+from icons import icon_path, fetch_icons, DEFAULT_ICON_BUDGET
 import subprocess 
-import urllib.request
-from urllib.error import URLError
-from common import get_email_domain
+from search import add_search_fields, fields_getter, build_index, index_rows
+from store import TABLE_SERIALIZER, pack_table, patch_table, update_index_rows, CacheSession
+from pipeline import Pipeline
 
 log = None
+# caches of this run, written once at exit
+session = None
+
+# force a full alias resync at least this often (seconds)
+DEFAULT_FULLSYNC = 86400*7
+# trust cached enabled/blocked states this long after a full sync (seconds)
+DEFAULT_STATE_AGE = 3600
 
 
 def alias_contact_new(result, wf, id):
@@ -21,12 +32,78 @@ def alias_contact_new(result, wf, id):
         return result['reverse_alias']+" in clipboard"
     return None
 
+def cache_items(wf, name, items):
+    """Cache a collection: full records in a side file, the fields the
+    filter needs as a packed table, and its search index - the last two
+    memory-mapped by the filter"""
+    session.store(name, list(filter(lambda x: x, items)))
+
+def cache_tables(wf, name, items):
+    """Cache the packed table and search index of a collection"""
+    wf.cache_data(name+'_index', build_index(items, fields_getter(name)), serializer=TABLE_SERIALIZER)
+    wf.cache_data(name, pack_table(items, name), serializer=TABLE_SERIALIZER)
+    # drop copies left in the default format by earlier versions
+    wf.cache_data(name+'_index', None)
+    wf.cache_data(name, None)
+
+def extend_tables(wf, name, positions, fresh):
+    """Drop the rows of replaced records from the table and search index
+    of a collection and append ``fresh`` ones, leaving the other rows be"""
+    if not patch_table(wf, name, {}, positions, fresh):
+        return False
+    update_index_rows(wf, name, positions, index_rows(fresh, fields_getter(name)))
+    return True
+
 def update_contacts(fresh, wf):
-    stored = wf.cached_data('contact', max_age=0)
-    ids = list(map(lambda x: x['id'], fresh))
-    stored = list(filter(lambda x: x['id'] not in ids, stored)) if ids else stored
-    stored.extend(fresh)      
-    wf.cache_data('contact', stored)        
+    session.merge('contact', fresh)
+
+def alias_toggle(result, wf, id):
+    if isinstance(result, dict) and 'enabled' in result:
+        session.patch('alias', id, {'enabled': result['enabled']})
+    return None
+
+# the enable/block actions return True if they changed the state, False if
+# it already was what they asked for, or an error string
+def alias_enable(result, wf, id):
+    if isinstance(result, bool):
+        session.patch('alias', id, {'enabled': True})
+    return None
+
+def alias_disable(result, wf, id):
+    if isinstance(result, bool):
+        session.patch('alias', id, {'enabled': False})
+    return None
+
+def alias_delete(result, wf, id):
+    if isinstance(result, dict) and result.get('deleted'):
+        session.remove('alias', id)
+    return None
+
+def contact_toggle(result, wf, id):
+    if isinstance(result, dict) and 'block_forward' in result:
+        session.patch('contact', id, {'block_forward': result['block_forward']})
+    return None
+
+def contact_block(result, wf, id):
+    if isinstance(result, bool):
+        session.patch('contact', id, {'block_forward': True})
+    return None
+
+def contact_unblock(result, wf, id):
+    if isinstance(result, bool):
+        session.patch('contact', id, {'block_forward': False})
+    return None
+
+def contact_enable(result, wf, id):
+    return contact_unblock(result, wf, id)
+
+def contact_disable(result, wf, id):
+    return contact_block(result, wf, id)
+
+def contact_delete(result, wf, id):
+    if isinstance(result, dict) and result.get('deleted'):
+        session.remove('contact', id)
+    return None
 
 def alias_upcontact(result, wf, id):
     if result:
@@ -54,17 +131,29 @@ def get_notify_name(wf, args):
     idkey = 'id'
     name = ''
     if not args[idkey]: return name
-    items = wf.cached_data(type, max_age=0)
-    #log.debug('items in notify is '+str(items))
-    if items:
-        item = next((x for x in items if str(args[idkey]) == str(x[idkey])), None)
+    item = session.get(type, args[idkey])
+    #log.debug('item in notify is '+str(item))
+    if item:
         name = item['email'] if 'email' in item else (item['contact'] if 'contact' in item else 'item')
         name = ' '.join(map(lambda x: x.capitalize(), re.split('[\.\s\-\,]+', name)))
     return name
 
 def get_alias(wf, id):
-    aliases = wf.cached_data('alias', max_age=0)
-    return next((x for x in aliases if id == x['id']), None)
+    return session.get('alias', id)
+
+def cached_state(wf):
+    """Lookup of cached aliases and contacts for the hub to skip actions
+    that would change nothing, trusted only shortly after a full sync -
+    an incremental one stops at the first unchanged page, so it leaves
+    older items as they were cached"""
+    max_age = int(wf.settings['simplelogin_state_age']) if 'simplelogin_state_age' in wf.settings else DEFAULT_STATE_AGE
+    state = get_sync_state(wf)
+    now = time.time()
+    def lookup(type, id):
+        if type not in state or now - state[type].get('full', 0) >= max_age:
+            return None
+        return session.get(type, id)
+    return lookup
 
 def get_client(wf, client_mac):
     clients = wf.cached_data('client', max_age=0)
@@ -74,18 +163,12 @@ def get_device(wf, device_mac):
     devices = wf.cached_data('device', max_age=0)
     return next((x for x in devices if device_mac == x['mac']), None)
 
-def download_icon(wf, contact):
-    name, toplevel = get_email_domain(contact['contact'])
-    if not name:
-        return None
-    filename = wf.cachefile(name+".png")
-    domain = name+'.'+toplevel
-    try:
-        urllib.request.urlretrieve('https://www.google.com/s2/favicons?domain='+domain+'&sz=128', filename)
-    except URLError:
-        log.info('no icon found for '+domain)
-        return None
-    return filename
+def fetch_icons_in_background(wf):
+    """Fetch missing contact favicons without holding up the update"""
+    run_in_background('icons',
+                    ['/usr/bin/python3',
+                    wf.workflowfile('command.py'),
+                    '--icons'])
 
 def get_hub(wf):
     need_setup = False
@@ -93,6 +176,8 @@ def get_hub(wf):
     try:
         apikey = wf.get_password('simplelogin_apikey')
     except PasswordNotFound:  
+        # removed from the keychain behind the workflow's back
+        wf.settings['simplelogin_apikey_set'] = False
         wf.add_item('No API key found...',
                     'Please use sl api to set your API key...',
                     valid=False,
@@ -102,16 +187,76 @@ def get_hub(wf):
         wf.send_feedback()
         exit(0)
     else:
-        hub = SimpleLogin(apikey=apikey)
+        concurrency = int(wf.settings['simplelogin_concurrency']) if 'simplelogin_concurrency' in wf.settings else DEFAULT_CONCURRENCY
+        hub = SimpleLogin(apikey=apikey, concurrency=concurrency, state=cached_state(wf))
     return hub
 
 def get_aliases(wf, hub):
     """Retrieve all aliases
 
-    Returns a list of aliases.
+    Returns an iterator over aliases, as they are downloaded.
 
     """
-    return hub.get_aliases()
+    return hub.iter_aliases()
+
+def get_sync_state(wf):
+    state = session.cached_data('sync')
+    return state if state else {}
+
+def set_sync_state(wf, state, name, items, full):
+    now = time.time()
+    collection = state.get(name, {})
+    collection['synced'] = now
+    collection['count'] = len(items)
+    if full:
+        collection['full'] = now
+    state[name] = collection
+    session.cache_data('sync', state)
+
+def api_fields(item):
+    return {k: v for k, v in item.items() if not k.startswith('_')}
+
+def sync_aliases(wf, hub, state, full=False):
+    """Bring the alias cache up to date
+
+    Fetches only the leading pages until it reaches aliases that are
+    already cached and unchanged, and merges those into the cache. Falls
+    back to a full download when one is due or when the merged count
+    does not match the server.
+
+    Returns a (list of aliases, was a full sync) tuple, or an error string.
+
+    """
+    fullsync = int(wf.settings['simplelogin_fullsync']) if 'simplelogin_fullsync' in wf.settings else DEFAULT_FULLSYNC
+    stored = session.load('alias')
+    last_full = state['alias']['full'] if 'alias' in state and 'full' in state['alias'] else 0
+    if not full and stored and time.time() - last_full < fullsync:
+        known = {x['id']: api_fields(x) for x in stored}
+        fresh = hub.get_aliases_until(lambda x: x['id'] in known and known[x['id']] == x)
+        if isinstance(fresh, str):
+            return fresh
+        fresh, reached_end = fresh
+        ids = set(map(lambda x: x['id'], fresh))
+        by_id = {x['id']: x for x in stored}
+        changed = 0
+        aliases = []
+        for x in fresh:
+            if x['id'] in known and known[x['id']] == x:
+                aliases.append(by_id[x['id']])
+            else:
+                aliases.append(post_process_item(wf, x))
+                changed += 1
+        if not reached_end:
+            aliases.extend(x for x in stored if x['id'] not in ids)
+        log.debug('incremental sync: '+str(len(fresh))+' aliases fetched, '+str(changed)+' new or changed')
+        stats = hub.get_stats()
+        if reached_end or not isinstance(stats, dict) or stats.get('nb_alias') in (None, len(aliases)):
+            return aliases, reached_end
+        log.info('alias cache diverged from server, doing a full sync')
+    try:
+        return run_pipeline(wf, 'alias', lambda: get_aliases(wf, hub)), True
+    except SimpleLoginError as e:
+        return str(e)
 
 def get_mailboxes(wf, hub):
     """Retrieve all mailboxes
@@ -129,13 +274,34 @@ def get_domains(wf, hub):
     """
     return hub.get_domains()
 
+def report_progress(wf, done, total):
+    wf.cache_data('progress', {'done': done, 'total': total})
+
+def cached_contacts(wf):
+    """Cached contacts of an alias by its email, for aliases whose contacts
+    could not be downloaded"""
+    by_alias = None
+    def lookup(alias, error):
+        nonlocal by_alias
+        log.info('keeping cached contacts for '+alias['email']+': '+error)
+        if by_alias is None:
+            by_alias = {}
+            for contact in session.load('contact') or []:
+                by_alias.setdefault(contact.get('alias'), []).append(dict(contact))
+        return by_alias.get(alias['email'], [])
+    return lookup
+
 def get_contacts(wf, hub, aliases):
     """Retrieve all contacts
 
-    Returns a list of contacts.
+    Returns an iterator over contacts, as they are downloaded.
 
     """
-    return hub.get_contacts(aliases)
+    try:
+        yield from hub.iter_contacts(aliases, progress=lambda done, total: report_progress(wf, done, total),
+                                     failed=cached_contacts(wf))
+    finally:
+        wf.cache_data('progress', None)
 
 def call_function(func_name, *args):
     # Attempt to fetch the function from local scope
@@ -157,18 +323,55 @@ def handle_commands(wf, hub, args):
         return 
     call = args.command_type+'_'+args.command
     params = {"param": args.command_params} if args.command_params else {}
+    # named before the command, which may patch or remove the cached item
+    name = get_notify_name(wf, vars(args))
     result = hub.call_dynamic(call, id=args.id, **params)
     message = call_function(call, result, wf, args.id)
     log.debug("type of result is "+str(type(result))+" and result is "+str(result))
     notify_command = re.sub(r'^(fw|pf)', '', args.command)
     notify_command = re.sub(r'e$','',notify_command)
-    message = get_notify_name(wf, vars(args))+' '+notify_command+'ed ' if not message else message
+    message = name+' '+notify_command+'ed ' if not message else message
     if not result or type(result) is not str:
         qnotify("SimpleLogin", message)
     else:
-        qnotify("SimpleLogin", get_notify_name(wf, vars(args))+' '+notify_command+' error: '+result)        
+        qnotify("SimpleLogin", name+' '+notify_command+' error: '+result)        
     return result
 
+def bulk_ids(wf, args):
+    """Ids a bulk command acts on: those given with --ids, or every cached
+    item of the command type that sl <query> would show for --match -
+    only the exact match, if there is one"""
+    if args.ids:
+        return args.ids
+    import filter as sl_filter
+    items = session.load(args.command_type) or []
+    matched = sl_filter.get_filtered_items(wf, args.match, items, fields_getter(args.command_type))
+    return [str(x['id']) for x in matched]
+
+def handle_bulk_commands(wf, hub, args):
+    if not args.command or not (args.ids or args.match):
+        return False
+    call = args.command_type+'_'+args.command
+    params = {"param": args.command_params} if args.command_params else {}
+    ids = bulk_ids(wf, args)
+    # named before the commands, which may patch or remove the cached items
+    names = [get_notify_name(wf, {'command_type': args.command_type, 'id': id}) or str(id) for id in ids]
+    results = hub.call_many(call, ids, **params)
+    failed = []
+    notify_command = re.sub(r'e$','',args.command)
+    for id, name, result in zip(ids, names, results):
+        if result is not None and type(result) is str:
+            log.info(name+' '+notify_command+' error: '+result)
+            failed.append(name)
+        else:
+            log.info(name+' '+notify_command+'ed')
+        call_function(call, result, wf, id)
+    message = str(len(ids)-len(failed))+' of '+str(len(ids))+' '+args.command_type+('es ' if args.command_type.endswith('s') else 's ')+notify_command+'ed'
+    if failed:
+        message += ', failed: '+', '.join(failed)
+    qnotify("SimpleLogin", message)
+    return True
+
 def get_name(item):
     type = get_item_type(item)
     names = { 'domain': 'suffix', 'alias': 'email', 'mailbox': 'email', 'contact': 'contact'}
@@ -183,7 +386,8 @@ def  beautify(name):
 
 def get_item_icon(wf, item):
     type = get_item_type(item)
-    filename = download_icon(wf, item) if 'contact' == type else None
+    # favicons are fetched later, the filter shows them once they exist
+    filename = icon_path(wf, item) if 'contact' == type else None
     filename = 'icons/'+type+'.png' if not filename else filename
     return filename
 
@@ -198,46 +402,99 @@ def get_item_type(item):
         return 'contact'
     return 'alias'
 
-def post_process_item(wf, item, name=None):
-    #log.debug("post processing "+str(item))
+def normalize_item(wf, item, name=None):
     item['_display_name'] = beautify(get_name(item))
     item['_type'] = get_item_type(item)
-    item['_icon'] = get_item_icon(wf, item)
     if name: item['alias'] = name
     return item
 
+def enrich_item(wf, item):
+    item['_icon'] = get_item_icon(wf, item)
+    return item
+
+def index_item(wf, item):
+    add_search_fields(item, item['_type'])
+    return item
+
+def post_process_item(wf, item, name=None):
+    #log.debug("post processing "+str(item))
+    return index_item(wf, enrich_item(wf, normalize_item(wf, item, name)))
+
+def start_pipeline(wf, name, source):
+    """Download a collection and post process it as it arrives, each step
+    in its own thread - call result() on it for the processed items"""
+    stages = [('normalize', lambda x: normalize_item(wf, x)),
+              ('enrich', lambda x: enrich_item(wf, x)),
+              ('index', lambda x: index_item(wf, x))]
+    return Pipeline(name, source, stages).start()
+
+def pipeline_result(pipeline):
+    items = pipeline.result()
+    log.debug(pipeline.summary())
+    return items
+
+def run_pipeline(wf, name, source):
+    return pipeline_result(start_pipeline(wf, name, source))
+
+def listed(result):
+    """A list returned by the hub, raising the error string it returns instead"""
+    if isinstance(result, str):
+        raise SimpleLoginError(result)
+    return result if result else []
+
 def handle_update(wf, args, hub):
     # Update clients if that is passed in
-    if args.update or args.exupdate:  
-        # update clients and devices
-        aliases = list(map(lambda x: post_process_item(wf, x), get_aliases(wf, hub)))
-        domains = list(map(lambda x: post_process_item(wf, x), get_domains(wf, hub)))
-        mailboxes = list(map(lambda x: post_process_item(wf, x), get_mailboxes(wf, hub)))
+    if args.update or args.exupdate or args.fullsync:  
+        # update aliases, domains and mailboxes - the last two alongside aliases
+        state = get_sync_state(wf)
+        pending = [start_pipeline(wf, 'domain', lambda: listed(get_domains(wf, hub))),
+                   start_pipeline(wf, 'mailbox', lambda: listed(get_mailboxes(wf, hub)))]
+        synced = sync_aliases(wf, hub, state, full=args.exupdate or args.fullsync)
+        aliases, full = synced if not isinstance(synced, str) else ([], False)
+        # one failing leaves the other, and the aliases, to be cached
+        domains, mailboxes = [], []
+        try:
+            domains = pipeline_result(pending[0])
+        except SimpleLoginError as e:
+            log.error('domain update failed: '+str(e))
+        try:
+            mailboxes = pipeline_result(pending[1])
+        except SimpleLoginError as e:
+            log.error('mailbox update failed: '+str(e))
         if aliases:
-            wf.cache_data('alias', aliases)
+            cache_items(wf, 'alias', aliases)
+            set_sync_state(wf, state, 'alias', aliases, full)
         if domains:
-            wf.cache_data('domain', domains)
+            cache_items(wf, 'domain', domains)
+            set_sync_state(wf, state, 'domain', domains, True)
         if mailboxes:
-            wf.cache_data('mailbox', mailboxes)
+            cache_items(wf, 'mailbox', mailboxes)
+            set_sync_state(wf, state, 'mailbox', mailboxes, True)
         if aliases:
             qnotify('SimpleLogin', 'aliases and domains updated')
         else:
             qnotify('SimpleLogin', 'aliases and domains update failed')
     if args.exupdate:
-        contacts = list(map(lambda x: post_process_item(wf, x), get_contacts(wf, hub, aliases)))
+        contacts = run_pipeline(wf, 'contact', lambda: get_contacts(wf, hub, aliases))
         if contacts:
-            wf.cache_data('contact', contacts)        
+            cache_items(wf, 'contact', contacts)
+            set_sync_state(wf, state, 'contact', contacts, True)
+    if args.update or args.exupdate or args.fullsync:
+        log.debug('connections opened: '+str(hub.http.stats['opened'])+', reused: '+str(hub.http.stats['reused']))
+        hub.http.close()
         return True # 0 means script exited cleanly
 
 def handle_config_commands(wf, args):
     result = False
     # Reinitialize if necessary
     if args.reinit:
+        daemon.stop()
         wf.reset()
         try:
             wf.delete_password('simplelogin_apikey')
         except PasswordNotFound:
             None
+        wf.settings['simplelogin_apikey_set'] = False
         qnotify('SimpleLogin', 'Workflow reinitialized')
         return True
 
@@ -248,12 +505,44 @@ def handle_config_commands(wf, args):
         qnotify('SimpleLogin', 'Update Frequency Saved')
         return True
 
+    if args.fullsync_freq:
+        log.debug('saving full sync freq '+args.fullsync_freq)
+        wf.settings['simplelogin_fullsync'] = int(args.fullsync_freq)
+        wf.settings.save()
+        qnotify('SimpleLogin', 'Full Sync Frequency Saved')
+        return True
+
+    if args.concurrency:
+        log.debug('saving concurrency '+args.concurrency)
+        wf.settings['simplelogin_concurrency'] = max(1, int(args.concurrency))
+        wf.settings.save()
+        qnotify('SimpleLogin', 'Concurrency Saved')
+        return True
+
+    if args.icon_budget:
+        log.debug('saving icon budget '+args.icon_budget)
+        wf.settings['simplelogin_icon_budget'] = max(0, int(args.icon_budget))
+        wf.settings.save()
+        qnotify('SimpleLogin', 'Icon Budget Saved')
+        return True
+
+    if args.daemon:
+        log.debug('saving daemon '+args.daemon)
+        wf.settings['simplelogin_daemon'] = 'on' == args.daemon
+        wf.settings.save()
+        if 'on' != args.daemon:
+            daemon.stop()
+        qnotify('SimpleLogin', 'Query Daemon '+('On' if 'on' == args.daemon else 'Off'))
+        return True
+
     # save username and password if that is passed in
     if args.api:  
         log.debug("saving API key... ")
         # save the key
         if args.api:
            wf.save_password('simplelogin_apikey', args.api)
+           # so the filter knows without asking the keychain
+           wf.settings['simplelogin_apikey_set'] = True
         qnotify('SimpleLogin', 'API key Saved')
         return True  # 0 means script exited cleanly
     
@@ -273,11 +562,19 @@ def main(wf):
     # action with the API key
     parser.add_argument('--api', dest='api', nargs='?', default=None)
     parser.add_argument('--freq', dest='freq', nargs='?', default=None)
+    parser.add_argument('--concurrency', dest='concurrency', nargs='?', default=None)
+    parser.add_argument('--daemon', dest='daemon', nargs='?', default=None)
+    parser.add_argument('--icon-budget', dest='icon_budget', nargs='?', default=None)
     # add an optional (nargs='?') --update argument and save its
     # value to 'apikey' (dest). This will be called from a separate "Run Script"
     # action with the API key
     parser.add_argument('--update', dest='update', action='store_true', default=False)
     parser.add_argument('--exupdate', dest='exupdate', action='store_true', default=False)
+    # fetch missing contact favicons
+    parser.add_argument('--icons', dest='icons', action='store_true', default=False)
+    # force a full alias download instead of an incremental one
+    parser.add_argument('--fullsync', dest='fullsync', action='store_true', default=False)
+    parser.add_argument('--fullsync-freq', dest='fullsync_freq', nargs='?', default=None)
     # reinitialize 
     parser.add_argument('--reinit', dest='reinit', action='store_true', default=False)
     # client name, mac, command and any command params
@@ -286,6 +583,9 @@ def main(wf):
     parser.add_argument('--command-params', dest='command_params', nargs='*', default=[])
 
     parser.add_argument('--id', dest='id', default=None)
+    # act on many items at once - these ids, or every item matching a query
+    parser.add_argument('--ids', dest='ids', nargs='*', default=[])
+    parser.add_argument('--match', dest='match', default=None)
 
     # add an optional query and save it to 'query'
     parser.add_argument('query', nargs='?', default=None)
@@ -293,6 +593,20 @@ def main(wf):
     args = parser.parse_args(wf.args)
     log.debug("args are "+str(args))
 
+    global session
+    session = CacheSession(wf, cache_tables, extend_tables)
+    try:
+        handle_args(wf, args)
+    finally:
+        flush_session(wf)
+    return 0
+
+def handle_args(wf, args):
+    if args.icons:
+        budget = int(wf.settings['simplelogin_icon_budget']) if 'simplelogin_icon_budget' in wf.settings else DEFAULT_ICON_BUDGET
+        log.debug('fetched '+str(fetch_icons(wf, session.load('contact'), budget=budget*1024*1024))+' icons')
+        return
+
     if(not handle_config_commands(wf, args)):
         hub = get_hub(wf)
         # handle any cache updates
@@ -300,8 +614,16 @@ def main(wf):
         # handle copy to clipboard
         if not handle_copy_command(wf, args):
             # handle any client or device commands there may be
-            handle_commands(wf, hub, args)
-    return 0
+            if not handle_bulk_commands(wf, hub, args):
+                handle_commands(wf, hub, args)
+
+def flush_session(wf):
+    """Write what this run changed, once"""
+    start = time.time()
+    written = session.flush()
+    log.debug('caches loaded: '+str(session.stats['loaded'])+', loads avoided: '+str(session.stats['avoided'])+', written: '+str(session.stats['written'])+' in '+str(round(time.time()-start, 3))+' sec')
+    if 'contact' in written:
+        fetch_icons_in_background(wf)
 
 
 if __name__ == u"__main__":
@@ -0,0 +1,156 @@
+# encoding: utf-8
+"""Resident query server for the script filter
+
+Alfred starts filter.py afresh for every keystroke. When the daemon
+setting is on, filter.py starts this server in the background and
+later keystrokes are forwarded to it over a Unix domain socket, so
+the interpreter, imports, settings and mapped caches stay warm. The
+server exits after IDLE_TIMEOUT seconds without a query, or as soon
+as the workflow's code changes underneath it.
+
+Only os and sys are imported at module level, and the socket machinery
+only once a daemon's socket exists, so checking for a daemon costs next
+to nothing when it is not running, and forwarding little when it is.
+
+"""
+
+import os
+import sys
+
+# seconds without a query before the daemon exits
+IDLE_TIMEOUT = 600
+# seconds the client waits for the daemon before filtering in-process
+CLIENT_TIMEOUT = 2
+# modules whose code the daemon has loaded
+SOURCES = ['filter.py', 'daemon.py', 'search.py', 'store.py', 'common.py']
+
+
+def socket_path():
+    """Path of the daemon's socket - kept short, as Unix socket paths are
+    limited to ~100 bytes and Alfred's cache directory is deep"""
+    bundleid = os.environ.get('alfred_workflow_bundleid')
+    if not bundleid:
+        return None
+    # $TMPDIR as tempfile.gettempdir() would pick it, without importing tempfile
+    return os.path.join(os.environ.get('TMPDIR') or '/tmp', bundleid+'.filter.sock')
+
+def send(request):
+    """Send ``request`` to the daemon, returning its reply or ``None``"""
+    path = socket_path()
+    if not path or not os.path.exists(path):
+        return None
+    import json
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CLIENT_TIMEOUT)
+            client.connect(path)
+            client.sendall(json.dumps(request).encode('utf-8'))
+            client.shutdown(socket.SHUT_WR)
+            return read_all(client)
+    except OSError:
+        return None
+
+def forward(args):
+    """Have a running daemon answer the query, printing its feedback
+
+    Returns ``False`` when there is no daemon to answer, or it could
+    not, and the query has to be run in-process.
+
+    """
+    # magic arguments act on the workflow itself, leave them to Workflow.args
+    if any(arg.startswith('workflow:') for arg in args):
+        return False
+    reply = send({'args': args})
+    if not reply:
+        return False
+    sys.stdout.write(reply.decode('utf-8'))
+    sys.stdout.flush()
+    return True
+
+def stop():
+    """Ask a running daemon to exit"""
+    return send({'stop': True}) is not None
+
+def source_mtimes(wf):
+    return [os.path.getmtime(wf.workflowfile(name)) for name in SOURCES if os.path.exists(wf.workflowfile(name))]
+
+def read_all(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def answer(request):
+    """Feedback JSON for one forwarded query"""
+    import json
+    from workflow import Workflow
+    import filter as sl_filter
+    # a fresh Workflow per query, so settings and feedback never leak between queries
+    wf = Workflow(update_settings={
+        'github_slug': 'schwark/alfred-simplelogin'
+    })
+    sl_filter.log = wf.logger
+    wf.check_update()
+    args = [wf.decode(arg) for arg in request['args']]
+    return json.dumps(sl_filter.feedback(wf, args))
+
+def serve(wf, idle_timeout=IDLE_TIMEOUT):
+    import json
+    import socket
+    log = wf.logger
+    path = socket_path()
+    if not path:
+        log.error('daemon: no bundle id, not serving')
+        return 1
+    if os.path.exists(path):
+        os.unlink(path)
+    sources = source_mtimes(wf)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(8)
+        server.settimeout(idle_timeout)
+        log.debug('daemon: serving on '+path)
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                log.debug('daemon: idle for '+str(idle_timeout)+' sec, exiting')
+                break
+            with conn:
+                conn.settimeout(CLIENT_TIMEOUT)
+                if source_mtimes(wf) != sources:
+                    # closing without a reply makes the client run the new code
+                    log.debug('daemon: workflow code changed, exiting')
+                    break
+                try:
+                    request = json.loads(read_all(conn).decode('utf-8'))
+                    if 'stop' in request:
+                        log.debug('daemon: asked to stop, exiting')
+                        break
+                    reply = answer(request)
+                    conn.sendall(reply.encode('utf-8'))
+                except Exception as e:
+                    log.exception('daemon: query failed: '+str(e))
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+    return 0
+
+def main(wf):
+    import signal
+    # remove the socket on kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return serve(wf, int(wf.settings.get('simplelogin_daemon_idle', IDLE_TIMEOUT)))
+
+
+if __name__ == u"__main__":
+    from workflow import Workflow
+    wf = Workflow()
+    sys.exit(wf.run(main))
@@ -1,15 +1,32 @@
 # encoding: utf-8
 
 import sys
-import re
-import argparse
+import daemon
+# let a running query daemon answer before importing anything else
+if __name__ == u"__main__" and daemon.forward(sys.argv[1:]):
+    sys.exit(0)
+import os
+import time
+from types import SimpleNamespace
 from workflow.workflow import MATCH_ATOM, MATCH_STARTSWITH, MATCH_SUBSTRING, MATCH_ALL, MATCH_INITIALS, MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN
-from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_ERROR, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, web, PasswordNotFound
+from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_ERROR, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, PasswordNotFound
 from workflow.background import run_in_background, is_running
-from common import get_email_domain
+from search import fields_getter, narrow, plan
+from store import TABLE_SERIALIZER, load_table, load_index
 
 log = None
 
+# a progress report older than this is left over from a crashed update
+PROGRESS_MAX_AGE = 60
+
+# results kept per collection - far more than Alfred shows at once
+MAX_RESULTS = 100
+
+# seconds between looks at whether a workflow update was found - only the
+# query daemon lives long enough to look more than once
+UPDATE_CHECK_INTERVAL = 3600
+update_checked = (0, False)
+
 def error(text):
     print(text)
     exit(0)
@@ -63,53 +80,28 @@ def get_item_subtitle(item, type):
 
     return subtitle
 
-def search_key_for_alias(alias):
-    """Generate a string search key for a client"""
-    if not alias:
-        return None
-    elements = []
-    if  'email' in alias:
-        elements.append(alias['email'])
-        elements.extend(alias['email'].split('@'))  # alias email parts
-    if  'latest_activity' in alias and alias['latest_activity'] and \
-        'contact' in alias['latest_activity'] and alias['latest_activity']['contact'] and \
-        'email' in alias['latest_activity']['contact'] and alias['latest_activity']['contact']['email']:
-            #elements.append(alias['latest_activity']['contact']['email'])
-            name, toplevel = get_email_domain(alias['latest_activity']['contact']['email'])
-            if name:
-                elements.append(name)  # sender email domain
-    return u' '.join(elements)
-
-def search_key_for_domain(domain):
-    """Generate a string search key for a domain"""
-    elements = []
-    #elements.append(domain['suffix'])
-    elements.append(domain['suffix'].split('@')[-1])  # name of domain
-    return u' '.join(elements)
-
-def search_key_for_mailbox(mailbox):
-    """Generate a string search key for a mailbox"""
-    elements = []
-    #elements.append(mailbox['email'])
-    elements.extend(mailbox['email'].split('@'))  # mailbox parts
-    return u' '.join(elements)
-
-def search_key_for_contact(contact):
-    """Generate a string search key for a contact"""
-    elements = []
-    matches = re.search('([^\.]+)@(.*)', contact['contact'])
-    elements.append(matches[1])
-    elements.append(matches[2])    
-    elements.append(contact['contact'])
-    return u' '.join(elements)
+def get_item_icon(item):
+    """The item's icon - its type's icon while a favicon is still being fetched"""
+    icon = item['_icon']
+    return icon if icon.startswith('icons/') or os.path.exists(icon) else 'icons/'+item['_type']+'.png'
+
+def apikey_set(wf):
+    """Whether an API key has been saved, without asking the keychain -
+    command.py keeps the simplelogin_apikey_set setting up to date, and the
+    keychain is only asked once, by installs from before the setting"""
+    if 'simplelogin_apikey_set' not in wf.settings:
+        try:
+            wf.get_password('simplelogin_apikey')
+            wf.settings['simplelogin_apikey_set'] = True
+        except PasswordNotFound:
+            wf.settings['simplelogin_apikey_set'] = False
+    return wf.settings['simplelogin_apikey_set']
 
 def add_prereq(wf, args):
     result = False
     word = args.query.lower().split(' ')[0] if args.query else ''
     # check API key
-    try:
-        apikey = wf.get_password('simplelogin_apikey')
-    except PasswordNotFound:  
+    if not apikey_set(wf):
         if word != 'api':
             wf.add_item('No API key found...',
                         'Please use sl api to set your API key',
@@ -117,9 +109,9 @@ def add_prereq(wf, args):
                         icon=ICON_ERROR)
         result = True
     # check aliases
-    aliases = wf.cached_data('alias', max_age=0)
-    domains = wf.cached_data('domain', max_age=0)
-    mailboxes = wf.cached_data('mailbox', max_age=0)
+    aliases = load_table(wf, 'alias')
+    domains = load_table(wf, 'domain')
+    mailboxes = load_table(wf, 'mailbox')
     if (not aliases or not domains or not mailboxes):
         if word != 'update':
             wf.add_item('No aliases...',
@@ -128,7 +120,7 @@ def add_prereq(wf, args):
                     icon=ICON_NOTE)
         result = True
     # Check for an update and if available add an item to results
-    if wf.update_available:
+    if update_available(wf):
         # Add a notification to top of Script Filter results
         wf.add_item('New version available',
             'Action this item to install the update',
@@ -136,6 +128,19 @@ def add_prereq(wf, args):
             icon=ICON_INFO)
     return result
 
+def update_available(wf):
+    """wf.update_available, looked at once per UPDATE_CHECK_INTERVAL"""
+    global update_checked
+    now = time.time()
+    if now - update_checked[0] >= UPDATE_CHECK_INTERVAL:
+        update_checked = (now, wf.update_available)
+    return update_checked[1]
+
+def parse_args(argv):
+    """The script filter's arguments - just the query, so parsed without
+    argparse, which takes longer to import than a keystroke takes to filter"""
+    return SimpleNamespace(query=argv[0] if argv else None)
+
 def add_config_commands(wf, query, config_commands):
     word = query.lower().split(' ')[0] if query else ''
     config_command_list = wf.filter(word, config_commands.keys(), min_score=80)
@@ -159,26 +164,32 @@ def filter_exact_match(query, result):
                 break
     return result
 
-def get_filtered_items(wf, query, items, search_func):
-    result = wf.filter(query, items, key=search_func, min_score=80)
+def get_filtered_items(wf, query, items, search_func, index=None):
+    fold_diacritics = wf.settings.get('__workflow_diacritic_folding', True)
+    items = narrow(index, query, items, min_score=80, fold_diacritics=fold_diacritics)
+    result = wf.filter(query, items, search_fields=search_func, min_score=80, max_results=MAX_RESULTS)
     result = filter_exact_match(query, result)
     return result
 
+def get_planned_items(wf, query, items, search_func, index=None):
+    """Filter items for the query, the query minus one word and the query
+    minus two words in a single pass"""
+    words = query.split() if query else []
+    results = plan(wf, query, items, search_func, index, min_score=80, prefixes=2, max_results=MAX_RESULTS)
+    queries = [query, ' '.join(words[0:-1]), ' '.join(words[0:-2])]
+    return [filter_exact_match(queries[i], results[i]) if 0 == i or len(words) > i else [] for i in range(3)]
+
 def get_id(item):
     if 'mac' in item:
         return item['mac']
     else:
         return item['_id']
 
-def extract_commands(wf, args, clients, filter_func, valid_commands):
-    words = args.query.split() if args.query else []
+def extract_commands(wf, args, clients, planned, valid_commands):
     result = vars(args)
     if clients:
-        clients = list(filter(lambda x: x, clients))
         #log.debug("clients are: "+str(clients))
-        full_clients = get_filtered_items(wf, args.query,  clients, filter_func)
-        minusone_clients = get_filtered_items(wf, ' '.join(words[0:-1]),  clients, filter_func) if len(words) > 1 else []
-        minustwo_clients = get_filtered_items(wf, ' '.join(words[0:-2]),  clients, filter_func) if len(words) > 2 else []
+        full_clients, minusone_clients, minustwo_clients = planned
 
         #log.debug('full client '+str(full_clients[0])+', and minus one is '+str(minusone_clients[0]))
         if 1 == len(minusone_clients) and (0 == len(full_clients) or (1 == len(full_clients) and get_id(full_clients[0]) == get_id(minusone_clients[0]))):
@@ -207,14 +218,11 @@ def get_valid_commands(items):
 def get_device_map(devices):
     return { x['mac'] if x and 'mac' in x else None: x for x in devices } if devices else None
 
-def main(wf):
-    # build argument parser to parse script args and collect their
-    # values
-    parser = argparse.ArgumentParser()
-    # add an optional query and save it to 'query'
-    parser.add_argument('query', nargs='?', default=None)
+def feedback(wf, argv):
+    """Build the script filter results for ``argv`` and return them as
+    Alfred feedback - in-process or inside the query daemon"""
     # parse the script's arguments
-    args = parser.parse_args(wf.args)
+    args = parse_args(argv)
     log.debug("args are "+str(args))
 
     # update query post extraction
@@ -282,6 +290,14 @@ def main(wf):
             'icon': ICON_SYNC,
             'valid': True
         },
+        'fullsync': {
+            'title': 'Full update of aliases, domains and mailboxes',
+            'subtitle': 'Download every alias again instead of only the new and changed ones',
+            'autocomplete': 'fullsync',
+            'args': ' --fullsync',
+            'icon': ICON_SYNC,
+            'valid': True
+        },
         'exupdate': {
             'title': 'Extended update including contacts',
             'subtitle': 'Extended update of everything including contacts',
@@ -306,6 +322,38 @@ def main(wf):
             'icon': ICON_WEB,
             'valid': len(words) > 1
         },
+        'syncfreq': {
+            'title': 'Set full alias sync frequency',
+            'subtitle': 'Every (x) seconds, sl update downloads every alias instead of only new and changed ones',
+            'autocomplete': 'syncfreq',
+            'args': ' --fullsync-freq '+(words[1] if len(words)>1 else ''),
+            'icon': ICON_WEB,
+            'valid': len(words) > 1
+        },
+        'concurrency': {
+            'title': 'Set number of parallel requests during update',
+            'subtitle': 'Up to (x) pages will be fetched from SimpleLogin at the same time',
+            'autocomplete': 'concurrency',
+            'args': ' --concurrency '+(words[1] if len(words)>1 else ''),
+            'icon': ICON_WEB,
+            'valid': len(words) > 1
+        },
+        'iconbudget': {
+            'title': 'Set space for contact icons',
+            'subtitle': 'Keep up to (x) megabytes of contact icons, dropping the least recently used',
+            'autocomplete': 'iconbudget',
+            'args': ' --icon-budget '+(words[1] if len(words)>1 else ''),
+            'icon': ICON_WEB,
+            'valid': len(words) > 1
+        },
+        'daemon': {
+            'title': 'Turn the query daemon on or off',
+            'subtitle': 'Keep a background process running to answer queries faster (on/off)',
+            'autocomplete': 'daemon',
+            'args': ' --daemon '+(words[1] if len(words)>1 else ''),
+            'icon': ICON_WEB,
+            'valid': len(words) > 1 and words[1] in ['on', 'off']
+        },
         'reinit': {
             'title': 'Reinitialize the workflow',
             'subtitle': 'CAUTION: this deletes all devices, clients and credentials...',
@@ -328,12 +376,11 @@ def main(wf):
     # add config commands to filter
     add_config_commands(wf, query, config_commands)
     if(add_prereq(wf, args)):
-        wf.send_feedback()
-        return 0
+        return wf.obj
  
     freq = int(wf.settings['simplelogin_freq']) if 'simplelogin_freq' in wf.settings else 86400*30
     # Is cache over 1 month old or non-existent?
-    if not wf.cached_data_fresh('alias', freq):
+    if not wf.cached_data_fresh('alias', freq, TABLE_SERIALIZER):
         run_in_background('update',
                         ['/usr/bin/python3',
                         wf.workflowfile('command.py'),
@@ -354,41 +401,50 @@ def main(wf):
         wf.rerun = 0.5
         # Add a notification if the script is running
         wf.add_item('Updating contacts, aliases, mailboxes and domains...', icon=ICON_INFO)
+    elif wf.cached_data_fresh('progress', PROGRESS_MAX_AGE):
+        # contacts are being harvested by sl exupdate
+        progress = wf.cached_data('progress', max_age=0)
+        wf.rerun = 0.5
+        wf.add_item('Updating contacts...', str(progress['done'])+' of '+str(progress['total'])+' aliases scanned', icon=ICON_INFO)
     elif query:
         # retrieve cached clients and devices
-        aliases = wf.cached_data('alias', max_age=0)
-        mailboxes = wf.cached_data('mailbox', max_age=0)
-        domains = wf.cached_data('domain', max_age=0)
-        contacts = wf.cached_data('contact', max_age=0)
+        aliases = load_table(wf, 'alias')
+        mailboxes = load_table(wf, 'mailbox')
+        domains = load_table(wf, 'domain')
+        contacts = load_table(wf, 'contact')
 
         items = [
             {
                 'name': 'aliases',
+                'index': load_index(wf, 'alias'),
                 'list': aliases,
                 'commands': alias_commands,
                 'id': 'id',
-                'filter': search_key_for_alias
+                'filter': fields_getter('alias')
             },
             {
                 'name': 'mailboxes',
+                'index': load_index(wf, 'mailbox'),
                 'list': mailboxes,
                 'commands': mailbox_commands,
                 'id': 'id',
-                'filter': search_key_for_mailbox
+                'filter': fields_getter('mailbox')
             },
             {
                 'name': 'domains',
+                'index': load_index(wf, 'domain'),
                 'list': domains,
                 'commands': domain_commands,
                 'id': 'suffix',
-                'filter': search_key_for_domain
+                'filter': fields_getter('domain')
             },
             {
                 'name': 'contacts',
+                'index': load_index(wf, 'contact'),
                 'list': contacts,
                 'commands': contact_commands,
                 'id': 'id',
-                'filter': search_key_for_contact
+                'filter': fields_getter('contact')
             },
         ]
         
@@ -396,15 +452,21 @@ def main(wf):
         total_results = 0
         
         for item in items:
-            item['list'] = list(filter(lambda x: x, item['list'] if item['list'] else []))
-            parts = extract_commands(wf, args, item['list'], item['filter'], item['commands'])
-            query = parts['query']
-            item_list = get_filtered_items(wf, query, item['list'], item['filter'])
+            # one scan per collection serves command extraction and results
+            query = args.query
+            planned = get_planned_items(wf, query, item['list'], item['filter'], item['index']) if item['list'] else [[], [], []]
+            parts = extract_commands(wf, args, item['list'], planned, item['commands'])
+            item['parts'] = parts
+            if parts['query'] == query:
+                item_list = planned[0]
+            else:
+                # a command was split off the query, look up what it names
+                item_list = get_filtered_items(wf, parts['query'], item['list'], item['filter'], item['index'])
             result_items[item['name']] = item_list
             total_results = total_results + len(item_list)
         
         for item in items:
-            parts = extract_commands(wf, args, item['list'], item['filter'], item['commands'])
+            parts = item['parts']
             query = parts['query']
             item_list = result_items[item['name']]
 
@@ -430,7 +492,7 @@ def main(wf):
                                 arg=' --'+item['id']+' "'+str(single[item['id']])+'" --command-type '+single['_type']+' --command '+item['commands'][command]['command']+(' --command-params "'+(','.join(param_str))+'"' if param_str else ''),
                                 autocomplete=name+' '+command,
                                 valid=bool('params' not in item['commands'][command] or len(param_str) >= len(item['commands'][command]['params'])),
-                                icon=single['_icon'])
+                                icon=get_item_icon(single))
                 # Loop through the returned clients and add an item for each to
                 # the list of results for Alfred
                 for single in item_list:
@@ -441,10 +503,22 @@ def main(wf):
                             arg=' --'+item['id']+' "'+str(single[item['id']])+'" --command-type '+item_type+' --command clip --command-params "'+(name if name else '')+'"',
                             autocomplete=name,
                             valid=len(item['commands']) < 2,
-                            icon=single['_icon'])
+                            icon=get_item_icon(single))
+
+    return wf.obj
 
-        # Send the results to Alfred as XML
+def start_daemon(wf):
+    """Start the query daemon if it is turned on and not yet running"""
+    if wf.settings.get('simplelogin_daemon') and not is_running('daemon'):
+        run_in_background('daemon',
+                        ['/usr/bin/python3',
+                        wf.workflowfile('daemon.py')])
+
+def main(wf):
+    feedback(wf, wf.args)
+    # Send the results to Alfred as JSON
     wf.send_feedback()
+    start_daemon(wf)
     return 0
 
 
@@ -0,0 +1,154 @@
+# encoding: utf-8
+"""Favicons for contacts, fetched once per sender domain
+
+Every cached favicon has an entry in the 'icons' cache::
+
+    {'fetched_at': when the file was last fetched or revalidated,
+     'etag': ..., 'last_modified': ...,  # validators from the server
+     'size': bytes on disk,
+     'last_used': last update that had a contact on this domain,
+     'failures': fetches failed in a row,
+     'retry_at': no fetch before this time (failures and evictions)}
+
+Favicons older than ICON_TTL are revalidated with a conditional request.
+Failed domains back off exponentially, and once the icons use more than
+the byte budget the least recently used ones are deleted.
+
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from workflow import web
+from workflow.util import atomic_writer
+from common import get_email_domain
+
+ICON_URL = 'https://www.google.com/s2/favicons?sz=128&domain='
+# favicons fetched at the same time
+ICON_CONCURRENCY = 8
+# seconds before giving up on one favicon
+ICON_TIMEOUT = 10
+# seconds before a favicon is revalidated
+ICON_TTL = 86400*30
+# seconds before a failed domain is retried, doubled for every further failure
+ICON_RETRY = 3600
+ICON_MAX_RETRY = 86400*30
+# megabytes of favicons kept in the cache dir
+DEFAULT_ICON_BUDGET = 10
+
+log = logging.getLogger('icons')
+
+
+def icon_domain(contact):
+    """(cache name, domain) of a contact's favicon, or (None, None)"""
+    name, toplevel = get_email_domain(contact['contact']) if contact and 'contact' in contact else (None, None)
+    if not name:
+        return None, None
+    return name, name+'.'+toplevel
+
+def icon_path(wf, contact):
+    """Where the favicon for a contact is cached, whether fetched yet or not"""
+    name, domain = icon_domain(contact)
+    return wf.cachefile(name+'.png') if name else None
+
+def contact_domains(contacts):
+    """Domains of ``contacts`` by cache name, once each"""
+    domains = {}
+    for contact in contacts if contacts else []:
+        name, domain = icon_domain(contact)
+        if name:
+            domains[name] = domain
+    return domains
+
+def icon_entry(wf, meta, name):
+    """Metadata for favicon ``name``, adopting files cached without any"""
+    if name not in meta:
+        filename = wf.cachefile(name+'.png')
+        entry = {'fetched_at': 0, 'etag': None, 'last_modified': None, 'size': 0,
+                 'last_used': 0, 'failures': 0, 'retry_at': 0}
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            entry['fetched_at'] = stat.st_mtime
+            entry['size'] = stat.st_size
+        meta[name] = entry
+    return meta[name]
+
+def needs_fetch(wf, entry, name, now):
+    if entry['retry_at'] > now:
+        return False
+    return not os.path.exists(wf.cachefile(name+'.png')) or now - entry['fetched_at'] >= ICON_TTL
+
+def fetch_icon(http, filename, domain, entry, timeout=ICON_TIMEOUT):
+    """Fetch or revalidate one favicon, returning the fields of its entry that changed"""
+    headers = {}
+    if os.path.exists(filename):
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    r = http.request('GET', ICON_URL+domain, headers=headers, timeout=timeout, allow_redirects=True)
+    r.raise_for_status()
+    changes = {'fetched_at': time.time(), 'failures': 0, 'retry_at': 0}
+    if 304 == r.status_code:
+        return changes
+    with atomic_writer(filename, 'wb') as f:
+        f.write(r.content)
+    changes['etag'] = r.headers.get('etag')
+    changes['last_modified'] = r.headers.get('last-modified')
+    changes['size'] = len(r.content)
+    return changes
+
+def evict_icons(wf, meta, budget, now):
+    """Delete least recently used favicons until they fit in ``budget`` bytes"""
+    cached = [name for name in meta if meta[name]['size']]
+    total = sum(meta[name]['size'] for name in cached)
+    evicted = 0
+    for name in sorted(cached, key=lambda x: meta[x]['last_used']):
+        if total <= budget:
+            break
+        filename = wf.cachefile(name+'.png')
+        if os.path.exists(filename):
+            os.unlink(filename)
+        total -= meta[name]['size']
+        meta[name]['size'] = 0
+        # not fetched straight back in by the next update
+        meta[name]['retry_at'] = now + ICON_TTL
+        evicted += 1
+    return evicted
+
+def fetch_icons(wf, contacts, concurrency=ICON_CONCURRENCY, timeout=ICON_TIMEOUT, budget=DEFAULT_ICON_BUDGET*1024*1024):
+    """Fetch the favicons ``contacts`` are missing or have had too long,
+    one per domain, then trim the favicons to ``budget`` bytes
+
+    Returns the number of favicons fetched or revalidated.
+
+    """
+    now = time.time()
+    meta = wf.cached_data('icons', max_age=0) or {}
+    domains = contact_domains(contacts)
+    due = {}
+    for name, domain in domains.items():
+        entry = icon_entry(wf, meta, name)
+        entry['last_used'] = now
+        if needs_fetch(wf, entry, name, now):
+            due[name] = domain
+    log.debug('fetching '+str(len(due))+' of '+str(len(domains))+' icons')
+    fetched = 0
+    if due:
+        with web.Session() as http, ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = {pool.submit(fetch_icon, http, wf.cachefile(name+'.png'), domain, meta[name], timeout): name for name, domain in due.items()}
+            for future in as_completed(futures):
+                entry = meta[futures[future]]
+                try:
+                    entry.update(future.result())
+                    fetched += 1
+                except Exception as e:
+                    entry['failures'] += 1
+                    entry['retry_at'] = time.time() + min(ICON_RETRY * 2 ** (entry['failures'] - 1), ICON_MAX_RETRY)
+                    log.info('no icon found for '+due[futures[future]]+' ('+str(entry['failures'])+' failures): '+str(e))
+    evicted = evict_icons(wf, meta, budget, now)
+    if evicted:
+        log.debug('evicted '+str(evicted)+' icons')
+    wf.cache_data('icons', meta)
+    return fetched
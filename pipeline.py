@@ -0,0 +1,146 @@
+# encoding: utf-8
+"""Staged pipeline for cache updates
+
+Items flow from a source through a chain of stages, each running in its
+own thread with a bounded queue in front of it, so downloading, post
+processing and collecting overlap instead of running one after the other
+over whole lists. Items keep their order. The first error in any stage
+stops the pipeline and is raised by :meth:`Pipeline.result`.
+
+"""
+
+import time
+import queue
+import threading
+
+# items waiting between two stages
+QUEUE_SIZE = 64
+
+_DONE = object()
+
+
+class Pipeline(object):
+    """``source`` is called in its own thread and returns an iterable of
+    items, which pass through ``stages`` - a list of (name, function)
+    pairs - and are handed to ``sink`` by :meth:`result`
+
+    ``timing`` holds the seconds each stage spent on items, ``count``
+    the items collected.
+
+    """
+
+    def __init__(self, name, source, stages, sink=None, size=QUEUE_SIZE, source_name='fetch', sink_name='write'):
+        self.name = name
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.size = size
+        self.source_name = source_name
+        self.sink_name = sink_name
+        self.timing = {source_name: 0.0}
+        self.timing.update((stage, 0.0) for stage, func in stages)
+        self.timing[sink_name] = 0.0
+        self.count = 0
+        self.elapsed = 0.0
+        self.error = None
+        self.threads = []
+        self.outbox = None
+        self.started = None
+
+    def start(self):
+        """Start fetching and processing in the background"""
+        self.started = time.perf_counter()
+        outbox = queue.Queue(self.size)
+        self.threads.append(threading.Thread(target=self._produce, args=(outbox,), daemon=True))
+        for stage, func in self.stages:
+            inbox, outbox = outbox, queue.Queue(self.size)
+            self.threads.append(threading.Thread(target=self._stage, args=(stage, func, inbox, outbox), daemon=True))
+        self.outbox = outbox
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def result(self):
+        """Hand every item to the sink, returning them as a list if there
+        is no sink, once the pipeline is done"""
+        if self.started is None:
+            self.start()
+        items = []
+        sink = self.sink if self.sink else items.append
+        try:
+            while True:
+                item = self._get(self.outbox)
+                if item is _DONE:
+                    break
+                start = time.perf_counter()
+                sink(item)
+                self.timing[self.sink_name] += time.perf_counter() - start
+                self.count += 1
+        except Exception as e:
+            self._fail(e)
+        for thread in self.threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        if self.error is not None:
+            raise self.error
+        return items if not self.sink else None
+
+    def summary(self):
+        return self.name+': '+str(self.count)+' items in '+str(round(self.elapsed, 3))+' sec - '+\
+            ', '.join(stage+' '+str(round(seconds, 3)) for stage, seconds in self.timing.items())
+
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+
+    def _get(self, inbox):
+        # stops waiting once any stage has failed, as the stage before
+        # may have given up without handing on _DONE
+        while self.error is None:
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _put(self, outbox, item):
+        # gives up once a later stage has failed and stopped taking items
+        while True:
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if self.error is not None:
+                    return False
+
+    def _produce(self, outbox):
+        try:
+            start = time.perf_counter()
+            items = iter(self.source())
+            self.timing[self.source_name] += time.perf_counter() - start
+            while True:
+                start = time.perf_counter()
+                item = next(items, _DONE)
+                self.timing[self.source_name] += time.perf_counter() - start
+                if item is _DONE or not self._put(outbox, item):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(outbox, _DONE)
+
+    def _stage(self, stage, func, inbox, outbox):
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    break
+                start = time.perf_counter()
+                item = func(item)
+                self.timing[stage] += time.perf_counter() - start
+                if not self._put(outbox, item):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(outbox, _DONE)
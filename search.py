@@ -0,0 +1,194 @@
+# encoding: utf-8
+
+import re
+from array import array
+from bisect import bisect_left
+from workflow.workflow import MATCH_ALL, MATCH_ALLCHARS, MAX_WORD_SCORE, isascii, search_fields
+from common import get_email_domain
+from store import StringColumn
+
+# best score one query word can add to an item by MATCH_ALLCHARS alone
+# (see Workflow._filter_item) - any other rule can add MAX_WORD_SCORE
+MAX_ALLCHARS_SCORE = 50.0
+
+
+def search_key_for_alias(alias):
+    """Generate a string search key for a client"""
+    if not alias:
+        return None
+    elements = []
+    if  'email' in alias:
+        elements.append(alias['email'])
+        elements.extend(alias['email'].split('@'))  # alias email parts
+    if  'latest_activity' in alias and alias['latest_activity'] and \
+        'contact' in alias['latest_activity'] and alias['latest_activity']['contact'] and \
+        'email' in alias['latest_activity']['contact'] and alias['latest_activity']['contact']['email']:
+            #elements.append(alias['latest_activity']['contact']['email'])
+            name, toplevel = get_email_domain(alias['latest_activity']['contact']['email'])
+            if name:
+                elements.append(name)  # sender email domain
+    return u' '.join(elements)
+
+def search_key_for_domain(domain):
+    """Generate a string search key for a domain"""
+    elements = []
+    #elements.append(domain['suffix'])
+    elements.append(domain['suffix'].split('@')[-1])  # name of domain
+    return u' '.join(elements)
+
+def search_key_for_mailbox(mailbox):
+    """Generate a string search key for a mailbox"""
+    elements = []
+    #elements.append(mailbox['email'])
+    elements.extend(mailbox['email'].split('@'))  # mailbox parts
+    return u' '.join(elements)
+
+def search_key_for_contact(contact):
+    """Generate a string search key for a contact"""
+    elements = []
+    matches = re.search('([^\.]+)@(.*)', contact['contact'])
+    elements.append(matches[1])
+    elements.append(matches[2])
+    elements.append(contact['contact'])
+    return u' '.join(elements)
+
+SEARCH_KEYS = {
+    'alias': search_key_for_alias,
+    'domain': search_key_for_domain,
+    'mailbox': search_key_for_mailbox,
+    'contact': search_key_for_contact,
+}
+
+def add_search_fields(item, type):
+    """Store the precomputed search fields for an item on the item"""
+    item['_search'] = search_fields(SEARCH_KEYS[type](item))
+    return item
+
+def fields_getter(type):
+    """Function returning an item's precomputed search fields, deriving
+    them for items cached before they were stored"""
+    key = SEARCH_KEYS[type]
+    return lambda item: item['_search'] if '_search' in item else search_fields(key(item))
+
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+def index_grams(fields):
+    """All postings keys for a search key: its characters, plus the
+    trigrams of everything a query word can be matched against"""
+    lower = fields['folded_lower']
+    return set(fields['chars']) | trigrams(lower) | trigrams(fields['initials']) | trigrams(fields['capitals'])
+
+def index_rows(items, fields):
+    """Postings keys of each of ``items`` - none for an empty search key"""
+    return [index_grams(item_fields) if item_fields['value'] else set() for item_fields in map(fields, items)]
+
+def build_index(items, fields):
+    """Build an inverted index over the search fields of ``items``
+
+    Postings hold positions in ``items`` (after dropping empty items, as
+    filter.py does), keyed by single characters and trigrams. The sorted
+    keys are packed like a table column so the index can be memory-mapped.
+
+    """
+    postings = {}
+    items = list(filter(lambda x: x, items if items else []))
+    for i, grams in enumerate(index_rows(items, fields)):
+        for gram in grams:
+            postings.setdefault(gram, []).append(i)
+    grams = sorted(postings.keys())
+    starts = array('I', [0])
+    flat = array('I')
+    for gram in grams:
+        flat.extend(postings[gram])
+        starts.append(len(flat))
+    grams = StringColumn.pack(grams)
+    return {'count': len(items), 'grams': (grams.offsets, grams.blob), 'starts': starts, 'postings': flat}
+
+def _postings(index, gram):
+    grams = StringColumn(*index['grams'])
+    i = bisect_left(grams, gram)
+    if i == len(grams) or grams[i] != gram:
+        return []
+    return index['postings'][index['starts'][i]:index['starts'][i+1]]
+
+def _contains(postings, position):
+    i = bisect_left(postings, position)
+    return i < len(postings) and postings[i] == position
+
+def _intersect(index, grams, within=None):
+    lists = sorted((_postings(index, gram) for gram in grams), key=len)
+    result = set(within) if within is not None else None
+    for postings in lists:
+        if result is None:
+            result = set(postings)
+        elif len(result) * 16 < len(postings):
+            result = {i for i in result if _contains(postings, i)}
+        else:
+            result.intersection_update(postings)
+        if not result:
+            break
+    return result if result is not None else set()
+
+def candidates(index, query, min_score=0, match_on=MATCH_ALL, fold_diacritics=True):
+    """Positions of the items that could score above ``min_score`` for ``query``
+
+    Returns ``None`` when the index cannot narrow the search, i.e. every
+    item has to be scored.
+
+    """
+    if not index or not query or not query.strip():
+        return None
+    query = query.strip().lower()
+    if not fold_diacritics or not isascii(query):
+        return None
+    words = [s.strip() for s in query.split(' ') if s.strip()]
+    weak_score = MAX_ALLCHARS_SCORE if match_on & MATCH_ALLCHARS else 0
+    # every rule needs all of the word's characters in the item;
+    # all but MATCH_ALLCHARS also need its trigrams
+    survivors = None
+    strong = []
+    for word in words:
+        survivors = _intersect(index, set(word), survivors)
+        if not survivors:
+            return set()
+        strong.append(_intersect(index, trigrams(word), survivors) if len(word) >= 3 else survivors)
+    if len(words) * weak_score > min_score:
+        return survivors
+    result = set()
+    for i in survivors:
+        bound = sum(MAX_WORD_SCORE if i in matches else weak_score for matches in strong)
+        if bound > min_score:
+            result.add(i)
+    return result
+
+def narrow(index, query, items, min_score=0, fold_diacritics=True):
+    """The subset of ``items`` (in their original order) worth scoring"""
+    if not index or index['count'] != len(items):
+        return items
+    found = candidates(index, query, min_score=min_score, fold_diacritics=fold_diacritics)
+    if found is None:
+        return items
+    return [items[i] for i in sorted(found)]
+
+def plan(wf, query, items, fields, index=None, min_score=0, prefixes=2, max_results=0):
+    """Filter ``items`` for ``query`` and for ``query`` minus each of its
+    last ``prefixes`` words, scoring every candidate only once
+
+    Returns one result list per query, longest first.
+
+    """
+    words = query.split() if query else []
+    fold_diacritics = wf.settings.get('__workflow_diacritic_folding', True)
+    if index and index['count'] == len(items) and words:
+        found = set()
+        for length in range(len(words), max(len(words) - prefixes, 1) - 1, -1):
+            subset = candidates(index, ' '.join(words[0:length]), min_score=min_score, fold_diacritics=fold_diacritics)
+            if subset is None:
+                found = None
+                break
+            found |= subset
+        if found is not None:
+            items = [items[i] for i in sorted(found)]
+    return wf.filter_prefixes(query, items, search_fields=fields, prefixes=prefixes, min_score=min_score, max_results=max_results)
@@ -1,20 +1,110 @@
 import sys
+import time
+import random
 import logging
+import threading
+import http.client
+from email.utils import parsedate_to_datetime
 from workflow import web
 from http.cookies import SimpleCookie
 import json
 import ssl
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 MAX_RESULTS = 20
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRY_AFTER = 2
+# retries of a throttled, failed or dropped request, waiting
+# BACKOFF_BASE * 2^n seconds (with jitter, at most MAX_BACKOFF) in between
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 30
+# requests per second by budget: (starting rate and burst, highest rate)
+RATE_BUDGETS = {
+    'read': (20, 100),
+    'write': (5, 20),
+}
+# rate regained by each request that was not throttled
+RATE_STEP = 0.5
+
+def backoff(attempt):
+    """Seconds to wait before retry #``attempt``, with full jitter"""
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+
+def retry_after(r):
+    """Seconds a response's Retry-After asks for, or None"""
+    value = r.headers.get('retry-after') if r is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class SimpleLoginError(Exception):
+    """Error of a streamed request, whose results are already being consumed"""
+
+class RateLimiter(object):
+    """Token bucket shared by every worker of a client
+
+    Starts at ``rate`` requests per second, halves on every 429 (and
+    pauses for its Retry-After) and climbs back by RATE_STEP with every
+    request that goes through, up to ``max_rate``.
+
+    """
+
+    def __init__(self, rate, max_rate):
+        self.rate = float(rate)
+        self.min_rate = float(rate) / 8
+        self.max_rate = float(max_rate)
+        self.burst = float(rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttled(self, pause):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            log.debug('throttled by server, '+str(round(self.rate, 2))+' requests/sec after a '+str(round(pause, 2))+' sec pause')
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_STEP)
 
 ssl._create_default_https_context = ssl._create_unverified_context
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('pysimplelogin')
 class SimpleLogin(object):
 
-    def __init__(self, apikey=None):
+    def __init__(self, apikey=None, concurrency=1, state=None):
         self.base = 'https://api.simplelogin.io'
         self.apikey = apikey
+        self.concurrency = max(1, int(concurrency or 1))
+        # state(type, id) -> cached alias/contact dict or None, trusted to
+        # skip actions that would not change anything
+        self.state = state
+        self.http = web.Session()
+        self.limiters = {name: RateLimiter(*budget) for name, budget in RATE_BUDGETS.items()}
         self.session = False
         self.cookies = {}
         self.metadata = self._meta
@@ -34,20 +124,27 @@ class SimpleLogin(object):
                 'result': 'aliases',
                 'url': lambda sf, **kwargs: '/api/v2/aliases?page_id='+str((kwargs['page'] if 'page' in kwargs else '0'))
             },
+            'stats': {
+                'url': '/api/stats'
+            },
             'random': {
                 'method': 'POST',
+                'budget': 'write',
                 'url': '/api/alias/random/new'
             },
             'custom': {
                 'method': 'POST',
+                'budget': 'write',
                 'url': '/api/v3/alias/custom/new'
             },
             'alias-delete': {
                 'method': 'DELETE',
+                'budget': 'write',
                 'url': lambda sf, **kwargs: '/api/aliases/'+str(kwargs['id'] if 'id' in kwargs else '')
             },
             'alias-toggle': {
                 'method': 'POST',
+                'budget': 'write',
                 'url': lambda sf, **kwargs: '/api/aliases/'+str(kwargs['id'] if 'id' in kwargs else '')+'/toggle',
             },
             'alias-details': {
@@ -64,6 +161,7 @@ class SimpleLogin(object):
             },
             'alias-contact_new': {
                 'method': 'POST',
+                'budget': 'write',
                 'url': lambda sf, **kwargs: '/api/aliases/'+str(kwargs['id'] if 'id' in kwargs else '')+'/contacts',
                 'data': {
                     'contact': lambda sf, **kwargs: kwargs['contact']
@@ -71,10 +169,12 @@ class SimpleLogin(object):
             },
             'contact-delete': {
                 'method': 'DELETE',
+                'budget': 'write',
                 'url': lambda sf, **kwargs: '/api/contacts/'+str(kwargs['id'] if 'id' in kwargs else '')
             },
             'contact-toggle': {
                 'method': 'POST',
+                'budget': 'write',
                 'url': lambda sf, **kwargs: '/api/contacts/'+str(kwargs['id'] if 'id' in kwargs else '')+'/toggle',
             },
         },
@@ -97,7 +197,7 @@ class SimpleLogin(object):
             result.update(self._meta['common'][step])
         return result
 
-    def _make_request(self, step, **kwargs):
+    def _make_request(self, step, stream=False, **kwargs):
         request_metadata = self._get_step_metadata(step)
         log.debug('kwargs are : '+str(kwargs))
         data = None
@@ -117,7 +217,7 @@ class SimpleLogin(object):
         if self.apikey:
             headers['Authentication'] = self.apikey
             log.debug('setting api key to '+self.apikey)
-        request_params = {'url': self._get_step_url(step, **kwargs), 'method': method, 'allow_redirects': redirect, 'headers': headers}
+        request_params = {'url': self._get_step_url(step, **kwargs), 'method': method, 'allow_redirects': redirect, 'headers': headers, 'stream': stream}
         if(data):
             if isinstance(data, dict):
                 data = {k : v(self, **kwargs) if callable(v) else v for k, v in data.items()}
@@ -127,7 +227,7 @@ class SimpleLogin(object):
             else:
                 request_params['data'] = data
         log.debug("request is "+str(request_params))
-        r = web.request(**request_params)
+        r = self.http.request(**request_params)
         if(r.status_code >= 200 and r.status_code <= 400 and 'set-cookie' in r.headers):
             cookies = SimpleCookie()
             cookies.load(r.headers['Set-Cookie'])
@@ -135,56 +235,140 @@ class SimpleLogin(object):
                 self.cookies[key] = value.value
         return r
 
-    def _get_results(self, step, **kwargs):
-        results = []
+    def _send(self, step, stream=False, **kwargs):
+        # wait for the step's rate budget, then back off and retry while
+        # throttled - and, for reads only, on server errors and dropped
+        # connections, as a repeated write could be applied twice
         step_metadata = self._get_step_metadata(step)
-        # keep trying pages if paged request
-        page = 0
-        while -1 != page:
-            tries = 0 # try a couple of times to resolve stale sessions as necessary
-            if 'paged' in step_metadata and step_metadata['paged']:
-                kwargs['page'] = page
-                log.debug('getting '+step+' page #'+str(page))
-                page = page + 1
-            while tries < 2:
-                log.debug("getting results for "+str(step)+" with args %s", str(kwargs))
-                r = self._make_request(step, **kwargs)
-                error = self._check_response(r,  step)
-                if(not error):
-                    tries = 2
-                    value = None
-                    json = r.json()
-                    if json:
-                        if 'result' in step_metadata and step_metadata['result'] in json:
-                            value = json[step_metadata['result']]
-                        else:
-                            value = json
-                        if 'paged' in step_metadata and step_metadata['paged']:
-                            if len(value) < 20:
-                                page = -1
-                            results.extend(value)
-                        else:
-                            results = value
-                            page = -1
+        limiter = self.limiters[step_metadata['budget'] if 'budget' in step_metadata else 'read']
+        idempotent = 'GET' == step_metadata.get('method', 'POST' if 'data' in step_metadata else 'GET')
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                r = self._make_request(step, stream=stream, **kwargs)
+            except (OSError, http.client.HTTPException) as e:
+                if not idempotent or attempt >= MAX_RETRIES:
+                    raise
+                r = None
+                delay = backoff(attempt)
+                log.debug(step+' failed: '+str(e))
+            else:
+                if 429 == r.status_code:
+                    wait = retry_after(r)
+                    delay = wait if wait is not None else max(DEFAULT_RETRY_AFTER, backoff(attempt))
+                    limiter.throttled(delay)
+                elif r.status_code >= 500 and idempotent:
+                    delay = backoff(attempt)
                 else:
-                    tries += 1
-                    log.debug('error '+str(error))
-                    results = error
-        return results
+                    limiter.succeeded()
+                    return r
+                if attempt >= MAX_RETRIES:
+                    return r
+            attempt += 1
+            log.debug('retrying '+step+' in '+str(round(delay, 2))+' sec (#'+str(attempt)+')')
+            time.sleep(delay)
+
+    def _get_page(self, step, **kwargs):
+        value = None
+        step_metadata = self._get_step_metadata(step)
+        log.debug("getting results for "+str(step)+" with args %s", str(kwargs))
+        r = self._send(step, **kwargs)
+        error = self._check_response(r,  step)
+        if(not error):
+            json = r.json()
+            if json:
+                if 'result' in step_metadata and step_metadata['result'] in json:
+                    value = json[step_metadata['result']]
+                else:
+                    value = json
+        else:
+            log.debug('error '+str(error))
+        return value, error
+
+    def _iter_page(self, step, **kwargs):
+        # the records of one page, decoded as they arrive
+        step_metadata = self._get_step_metadata(step)
+        if 'result' not in step_metadata:
+            value, error = self._get_page(step, **kwargs)
+            if error:
+                raise SimpleLoginError(error)
+            yield from value if value else []
+            return
+        log.debug("streaming results for "+str(step)+" with args %s", str(kwargs))
+        r = self._send(step, stream=True, **kwargs)
+        error = self._check_response(r, step) if r.status_code < 200 or r.status_code > 400 else None
+        if error:
+            raise SimpleLoginError(error)
+        rest = {}
+        yield from r.iter_json(step_metadata['result'], rest)
+        if 'error' in rest:
+            log.debug(step+': failed request with error '+str(rest['error']))
+            raise SimpleLoginError(rest['error'])
+
+    def _iter_pages(self, step, **kwargs):
+        page = 0
+        while True:
+            log.debug('getting '+step+' page #'+str(page))
+            count = 0
+            for item in self._iter_page(step, page=page, **kwargs):
+                count += 1
+                yield item
+            if count < MAX_RESULTS:
+                return
+            page += 1
+
+    def _iter_pages_concurrent(self, step, **kwargs):
+        # keep self.concurrency pages in flight, yield them in order and
+        # stop at the first short page, dropping whatever was prefetched past it
+        pending = {}
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        next_page = 0
+        fetch = lambda page: list(self._iter_page(step, page=page, **kwargs))
+        try:
+            for next_page in range(self.concurrency):
+                log.debug('prefetching '+step+' page #'+str(next_page))
+                pending[next_page] = pool.submit(fetch, next_page)
+            page = 0
+            while page in pending:
+                value = pending.pop(page).result()
+                yield from value
+                if len(value) < MAX_RESULTS:
+                    break
+                next_page += 1
+                log.debug('prefetching '+step+' page #'+str(next_page))
+                pending[next_page] = pool.submit(fetch, next_page)
+                page += 1
+        finally:
+            if pending:
+                log.debug('cancelling '+str(len(pending))+' overshoot pages of '+step)
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def iter_results(self, step, **kwargs):
+        """Records of a list endpoint as they are decoded, every page of
+        a paged one - raises SimpleLoginError on failure"""
+        step_metadata = self._get_step_metadata(step)
+        if 'paged' in step_metadata and step_metadata['paged']:
+            if self.concurrency > 1:
+                return self._iter_pages_concurrent(step, **kwargs)
+            return self._iter_pages(step, **kwargs)
+        return self._iter_page(step, **kwargs)
+
+    def _get_results(self, step, **kwargs):
+        step_metadata = self._get_step_metadata(step)
+        if 'paged' in step_metadata and step_metadata['paged']:
+            try:
+                return list(self.iter_results(step, **kwargs))
+            except SimpleLoginError as e:
+                return str(e)
+        value, error = self._get_page(step, **kwargs)
+        if error:
+            return error
+        return value if value is not None else []
 
     def _set_action(self, step, **kwargs):
-        result = False
-        tries = 0 # try a couple of times to resolve stale sessions as necessary
-        while tries < 2:
-            r = self._make_request(step, **kwargs)
-            result = self._check_response(r,  step)
-            if(not result):
-                result = True
-                tries = 2
-            else:
-                result = False
-                tries += 1
-        return result
+        r = self._send(step, **kwargs)
+        return not self._check_response(r,  step)
 
     def _check_response(self, r, operation):
         result = ''
@@ -207,21 +391,78 @@ class SimpleLogin(object):
     def get_aliases(self):
         return self._get_results('aliases')
 
+    def iter_aliases(self):
+        return self.iter_results('aliases')
+
+    def get_aliases_until(self, known):
+        # aliases come back newest first, so stop paging at the first page
+        # that holds nothing new or changed - returns (aliases, reached_end)
+        results = []
+        page = 0
+        while True:
+            log.debug('getting aliases page #'+str(page))
+            value, error = self._get_page('aliases', page=page)
+            if error:
+                return error
+            value = value if value else []
+            results.extend(value)
+            if len(value) < MAX_RESULTS:
+                return results, True
+            if all(map(known, value)):
+                return results, False
+            page += 1
+
+    def get_stats(self):
+        return self._get_results('stats')
+
     def get_domains(self):
         domains = self._get_results('domains')
-        if domains:
+        if isinstance(domains, list):
             domains = list(filter(lambda x: x['is_custom'], domains))
         return domains
 
     def get_mailboxes(self):
         return self._get_results('mailboxes')
 
-    def get_contacts(self, aliases=[]):
-        result = []
-        for alias in aliases:
-            contacts = list(map(lambda x: x.update({'alias': alias['email']}) or x, self._get_results('alias-contacts', id=alias['id'])))
-            result.extend(contacts)
-        return result
+    def _get_alias_contacts(self, alias):
+        # (contacts, error) of one alias
+        try:
+            contacts = list(self._iter_pages('alias-contacts', id=alias['id']))
+        except SimpleLoginError as e:
+            log.debug('failed to get contacts for '+alias['email']+': '+str(e))
+            return [], str(e)
+        return list(map(lambda x: x.update({'alias': alias['email']}) or x, contacts)), None
+
+    def iter_contacts(self, aliases=[], progress=None, failed=None):
+        """Contacts of ``aliases``, alias by alias in order, several aliases
+        fetched at once
+
+        If the contacts of an alias cannot be fetched, what
+        ``failed(alias, error)`` returns is yielded in their place - with
+        no ``failed``, SimpleLoginError is raised.
+
+        """
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            futures = [pool.submit(self._get_alias_contacts, alias) for alias in aliases]
+            for done, (alias, future) in enumerate(zip(aliases, futures), 1):
+                contacts, error = future.result()
+                if error is not None:
+                    if not failed:
+                        raise SimpleLoginError(error)
+                    contacts = failed(alias, error)
+                yield from contacts if contacts else []
+                if progress:
+                    progress(done, len(aliases))
+        finally:
+            # on an error or an abandoned iterator, drop the aliases not started
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def get_contacts(self, aliases=[], progress=None):
+        try:
+            return list(self.iter_contacts(aliases, progress))
+        except SimpleLoginError as e:
+            return str(e)
     
     def get_alias(self, id):
         return self._get_results('alias-details', id=id)
@@ -235,21 +476,36 @@ class SimpleLogin(object):
     def alias_upcontact(self, id):
         return self._get_results('alias-contacts', id=id)
         
+    def _cached_field(self, type, id, field):
+        item = self.state(type, id) if self.state else None
+        return item[field] if item and field in item else None
+
+    def _toggle_to(self, step, id, field, desired):
+        """Toggle until ``field`` is ``desired``, reading the state from
+        the toggle response instead of fetching it first
+
+        Returns True if it was toggled, False if it already was
+        ``desired``, or an error string.
+
+        """
+        result = self._get_results(step, id=id)
+        if not isinstance(result, dict):
+            return result
+        if field in result and result[field] != desired:
+            # it already was - toggle it back
+            result = self._get_results(step, id=id)
+            return result if not isinstance(result, dict) else False
+        return True
+
     def alias_enable(self, id):
-        result = False
-        alias = self.get_alias(id)
-        if alias and not alias['enabled']:
-            self.alias_toggle(id)
-            result = True
-        return result
+        if True == self._cached_field('alias', id, 'enabled'):
+            return False
+        return self._toggle_to('alias-toggle', id, 'enabled', True)
             
     def alias_disable(self, id):
-        result = False
-        alias = self.get_alias(id)
-        if alias and alias['enabled']:
-            self.alias_toggle(id)
-            result = True
-        return result
+        if False == self._cached_field('alias', id, 'enabled'):
+            return False
+        return self._toggle_to('alias-toggle', id, 'enabled', False)
             
     def alias_delete(self, id):
         return self._get_results('alias-delete', id=id)
@@ -258,14 +514,20 @@ class SimpleLogin(object):
         return self._get_results('contact-toggle', id=id)
         
     def contact_block(self, id):
-        result = self.contact_toggle(id)
-        if result and 'block_forward' in result and not result['block_forward']:
-            self.contact_toggle(id)
+        if True == self._cached_field('contact', id, 'block_forward'):
+            return False
+        return self._toggle_to('contact-toggle', id, 'block_forward', True)
             
     def contact_unblock(self, id):
-        result = self.contact_toggle(id)
-        if result and 'block_forward' in result and result['block_forward']:
-            self.contact_toggle(id)
+        if False == self._cached_field('contact', id, 'block_forward'):
+            return False
+        return self._toggle_to('contact-toggle', id, 'block_forward', False)
+
+    def contact_enable(self, id):
+        return self.contact_unblock(id)
+
+    def contact_disable(self, id):
+        return self.contact_block(id)
             
     def contact_delete(self, id):
         return self._get_results('contact-delete', id=id)
@@ -274,6 +536,20 @@ class SimpleLogin(object):
         if hasattr(self, name) and callable(func := getattr(self, name)):
             return func(*args, **kwargs)
 
+    def call_many(self, name, ids, **kwargs):
+        # one call per id, self.concurrency at a time over the shared
+        # connections - results come back in the order of ids
+        results = [None] * len(ids)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(self.call_dynamic, name, id=id, **kwargs): i for i, id in enumerate(ids)}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    log.debug(name+' failed for '+str(ids[futures[future]])+': '+str(e))
+                    results[futures[future]] = str(e)
+        return results
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
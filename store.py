@@ -0,0 +1,784 @@
+# encoding: utf-8
+
+import os
+import json
+import mmap
+import pickle
+import struct
+from array import array
+from bisect import bisect_left
+from workflow.workflow import manager, BaseSerializer, char_mask
+
+# serializer for the caches the script filter reads on every keystroke
+TABLE_SERIALIZER = 'mmap'
+
+# loaded caches by path, kept while their file is unchanged - this only
+# pays off in a long-lived process such as the query daemon
+loaded = {}
+
+# fields the script filter reads, per item type - nested fields are dotted
+FILTER_FIELDS = {
+    'alias': ['id', '_display_name', '_type', '_icon', 'email', 'enabled', 'mailbox.email'],
+    'mailbox': ['id', '_display_name', '_type', '_icon', 'email', 'verified', 'default'],
+    'domain': ['suffix', '_display_name', '_type', '_icon', 'is_custom', 'is_premium'],
+    'contact': ['id', '_display_name', '_type', '_icon', 'contact', 'alias', 'reverse_alias_address', 'block_forward'],
+}
+
+# field records are looked up by, per item type
+RECORD_KEYS = {'alias': 'id', 'mailbox': 'id', 'domain': 'suffix', 'contact': 'id'}
+
+# precomputed search fields (see workflow.workflow.search_fields)
+SEARCH_FIELDS = ['value', 'lower', 'ascii', 'folded', 'folded_lower', 'atoms', 'initials', 'capitals', 'chars', 'mask']
+
+# per-row state of a column value
+MISSING = 0
+NONE = 1
+PRESENT = 2
+
+
+class StringColumn(object):
+    """Strings packed into one utf-8 blob with an offsets array"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def pack(cls, strings):
+        offsets = array('I', [0])
+        parts = []
+        size = 0
+        for string in strings:
+            encoded = string.encode('utf-8')
+            parts.append(encoded)
+            size += len(encoded)
+            offsets.append(size)
+        return cls(offsets, b''.join(parts))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i+1]]).decode('utf-8')
+
+
+class Table(object):
+    """Read-only columnar view of a cached collection"""
+
+    def __init__(self, data):
+        self.count = data['count']
+        self.columns = {}
+        self.states = {}
+        self.kinds = {}
+        for name, column in data['columns'].items():
+            self.kinds[name] = column['kind']
+            if 'str' == column['kind']:
+                self.columns[name] = StringColumn(*column['values'])
+            else:
+                self.columns[name] = column['values']
+            self.states[name] = column['states']
+        self.nested = {}
+        for name in self.columns:
+            if '.' in name:
+                prefix, field = name.split('.', 1)
+                self.nested.setdefault(prefix, []).append(field)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return Row(self, i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield Row(self, i)
+
+    def state(self, name, i):
+        states = self.states[name]
+        return states[i] if states is not None else PRESENT
+
+    def value(self, name, i):
+        value = self.columns[name][i]
+        if 'bool' == self.kinds[name]:
+            return bool(value)
+        return value
+
+
+class Row(object):
+    """One item of a :class:`Table`, read lazily column by column"""
+
+    __slots__ = ('table', 'position')
+
+    def __init__(self, table, position):
+        self.table = table
+        self.position = position
+
+    def __contains__(self, name):
+        table = self.table
+        if name in table.nested:
+            return any(name+'.'+field in self for field in table.nested[name])
+        return name in table.columns and MISSING != table.state(name, self.position)
+
+    def __eq__(self, other):
+        return isinstance(other, Row) and self.table is other.table and self.position == other.position
+
+    def __hash__(self):
+        return hash((id(self.table), self.position))
+
+    def __repr__(self):
+        return 'Row('+str({name: self[name] for name in self.keys()})+')'
+
+    def __getitem__(self, name):
+        table = self.table
+        if name in table.nested:
+            nested = {field: self[name+'.'+field] for field in table.nested[name] if name+'.'+field in self}
+            return unpack_search(nested) if '_search' == name else nested
+        if name not in self:
+            raise KeyError(name)
+        if NONE == table.state(name, self.position):
+            return None
+        return table.value(name, self.position)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        return [name for name in list(self.table.nested) + list(self.table.columns) if '.' not in name and name in self]
+
+
+class MmapSerializer(BaseSerializer):
+    """Read-only memory-mapped serializer for packed caches
+
+    Arrays and byte strings are written as aligned raw buffers after a
+    JSON directory describing everything else. Loading maps the file
+    and returns :class:`memoryview` objects over those buffers, so a
+    reader only touches the pages it actually indexes.
+
+    """
+
+    is_binary = True
+    magic = b'SLMMAP01'
+    align = 8
+
+    @classmethod
+    def _encode(cls, obj, buffers):
+        if isinstance(obj, array):
+            buffers.append(obj.tobytes())
+            return {'__buffer__': len(buffers) - 1, 'format': obj.typecode}
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            buffers.append(bytes(obj))
+            return {'__buffer__': len(buffers) - 1, 'format': 'B'}
+        if isinstance(obj, dict):
+            return {key: cls._encode(value, buffers) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [cls._encode(value, buffers) for value in obj]
+        return obj
+
+    @classmethod
+    def _decode(cls, obj, view, spans):
+        if isinstance(obj, dict):
+            if '__buffer__' in obj:
+                start, size = spans[obj['__buffer__']]
+                return view[start:start+size].cast(obj['format'])
+            return {key: cls._decode(value, view, spans) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [cls._decode(value, view, spans) for value in obj]
+        return obj
+
+    @classmethod
+    def load(cls, file_obj):
+        """Map an open cache file and rebuild its directory
+
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+        :returns: object with buffers as :class:`memoryview`
+
+        """
+        mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[0:len(cls.magic)] != cls.magic:
+            raise ValueError('not a memory-mapped cache file')
+        start = len(cls.magic)
+        size, = struct.unpack_from('<Q', mapped, start)
+        start += 8
+        directory = json.loads(mapped[start:start+size].decode('utf-8'))
+        # buffers are laid out after the header, padded to alignment
+        start += size
+        start += cls._padding(start)
+        return cls._decode(directory['data'], memoryview(mapped)[start:], directory['buffers'])
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        """Write ``obj`` as a JSON directory followed by its raw buffers
+
+        :param obj: dicts, lists and JSON scalars holding arrays and bytes
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+
+        """
+        buffers = []
+        data = cls._encode(obj, buffers)
+        spans = []
+        offset = 0
+        for buffer in buffers:
+            offset += cls._padding(offset)
+            spans.append([offset, len(buffer)])
+            offset += len(buffer)
+        directory = json.dumps({'data': data, 'buffers': spans}, separators=(',', ':')).encode('utf-8')
+        header = cls.magic + struct.pack('<Q', len(directory)) + directory
+        file_obj.write(header + b'\0' * cls._padding(len(header)))
+        written = 0
+        for (start, size), buffer in zip(spans, buffers):
+            file_obj.write(b'\0' * (start - written))
+            file_obj.write(buffer)
+            written = start + size
+
+    @classmethod
+    def _padding(cls, size):
+        return -size % cls.align
+
+
+manager.register(TABLE_SERIALIZER, MmapSerializer)
+
+
+def pack_search(fields):
+    packed = dict(fields)
+    packed['atoms'] = ' '.join(fields['atoms'])
+    packed['chars'] = ''.join(sorted(fields['chars']))
+    # items cached before search fields had a mask
+    if 'mask' not in packed:
+        packed['mask'] = char_mask(fields['chars'])
+    return packed
+
+def unpack_search(packed):
+    fields = dict(packed)
+    fields['atoms'] = packed['atoms'].split(' ')
+    fields['chars'] = frozenset(packed['chars'])
+    return fields
+
+def get_path(item, path):
+    """(state, value) of a dotted field in a record"""
+    for part in path.split('.'):
+        if not isinstance(item, dict) or part not in item:
+            return MISSING, None
+        item = item[part]
+    return (NONE, None) if item is None else (PRESENT, item)
+
+def pack_column(states, values):
+    present = [value for state, value in zip(states, values) if PRESENT == state]
+    if all(isinstance(value, bool) for value in present):
+        kind, packed = 'bool', array('b', [1 if value else 0 for value in values])
+    elif all(isinstance(value, int) for value in present):
+        kind, packed = 'int', array('q', [value if value is not None else 0 for value in values])
+    else:
+        kind = 'str'
+        column = StringColumn.pack([str(value) if value is not None else '' for value in values])
+        packed = (column.offsets, column.blob)
+    all_present = all(PRESENT == state for state in states)
+    return {'kind': kind, 'values': packed, 'states': None if all_present else bytes(states)}
+
+def pack_table(items, type):
+    """Pack the fields the script filter needs from ``items`` into columns"""
+    items = list(filter(lambda x: x, items if items else []))
+    paths = FILTER_FIELDS[type] + ['_search.'+field for field in SEARCH_FIELDS]
+    searches = [pack_search(item['_search']) if '_search' in item else {} for item in items]
+    columns = {}
+    for path in paths:
+        if path.startswith('_search.'):
+            field = path.split('.', 1)[1]
+            cells = [(PRESENT, search[field]) if field in search else (MISSING, None) for search in searches]
+        else:
+            cells = [get_path(item, path) for item in items]
+        states = [state for state, value in cells]
+        if not any(states):
+            continue
+        columns[path] = pack_column(states, [value for state, value in cells])
+    return {'count': len(items), 'columns': columns}
+
+def as_rows(data):
+    """Items of a cached collection, whether packed or a plain list"""
+    if isinstance(data, dict) and 'columns' in data:
+        return Table(data)
+    return list(filter(lambda x: x, data if data else []))
+
+def load_mapped(wf, name, convert=lambda x: x):
+    """Memory-mapped cache ``name``, reused until the file is rewritten"""
+    path = wf.cachefile(name+'.'+TABLE_SERIALIZER)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        loaded.pop(path, None)
+        return convert(None)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if path not in loaded or loaded[path][0] != version:
+        loaded[path] = (version, convert(wf.cached_data(name, max_age=0, serializer=TABLE_SERIALIZER)))
+    return loaded[path][1]
+
+def load_table(wf, name):
+    """Packed table of a cached collection, mapped rather than unpickled -
+    or the list versions before tables cached, until an update replaces it"""
+    table = load_mapped(wf, name, as_rows)
+    if not table and wf.cached_data_age(name):
+        return as_rows(wf.cached_data(name, max_age=0))
+    return table
+
+def load_index(wf, name):
+    """Search index of a cached collection"""
+    return load_mapped(wf, name+'_index')
+
+class RecordIndex(object):
+    """Id index of a records file: where each record starts and ends, in
+    record order, plus a permutation sorting the ids for lookups"""
+
+    def __init__(self, data):
+        self.data = data
+        self.generation = data['generation']
+        self.keys = StringColumn(*data['keys']) if 'str' == data['kind'] else data['keys']
+        self.offsets = data['offsets']
+        self.lengths = data['lengths']
+        self.sorted = data['sorted']
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def key(self, i):
+        return self.keys[i]
+
+    def find(self, key):
+        """Position of the record for ``key``, or ``None``"""
+        if 'int' == self.data['kind']:
+            try:
+                key = int(key)
+            except (TypeError, ValueError):
+                return None
+        else:
+            key = str(key)
+        # bisect over the ids in sorted order without materialising them
+        sorted_keys = SortedKeys(self)
+        i = bisect_left(sorted_keys, key)
+        if i < len(sorted_keys) and sorted_keys[i] == key:
+            return self.sorted[i]
+        return None
+
+
+class SortedKeys(object):
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.index.keys[self.index.sorted[i]]
+
+
+def records_path(wf, name, generation):
+    return wf.cachefile(name+'.'+str(generation)+'.records')
+
+def pack_record_index(generation, keys, offsets, lengths, size):
+    kind = 'int' if all(isinstance(key, int) for key in keys) else 'str'
+    if 'int' == kind:
+        packed = array('q', keys)
+    else:
+        keys = [str(key) for key in keys]
+        column = StringColumn.pack(keys)
+        packed = (column.offsets, column.blob)
+    order = sorted(range(len(keys)), key=lambda i: keys[i])
+    return {'generation': generation, 'kind': kind, 'keys': packed,
+            'offsets': array('Q', offsets), 'lengths': array('I', lengths),
+            'sorted': array('I', order), 'live': sum(lengths), 'size': size}
+
+def load_record_index(wf, name):
+    data = wf.cached_data(name+'_ids', max_age=0, serializer=TABLE_SERIALIZER)
+    return RecordIndex(data) if data else None
+
+def write_records(wf, name, items):
+    """Write every record of a collection to a new records file"""
+    key = RECORD_KEYS[name]
+    index = load_record_index(wf, name)
+    generation = index.generation + 1 if index else 1
+    keys, offsets, lengths = [], [], []
+    size = 0
+    with open(records_path(wf, name, generation), 'wb') as f:
+        for item in items:
+            record = pickle.dumps(item, protocol=-1)
+            f.write(record)
+            keys.append(item[key])
+            offsets.append(size)
+            lengths.append(len(record))
+            size += len(record)
+    wf.cache_data(name+'_ids', pack_record_index(generation, keys, offsets, lengths, size), serializer=TABLE_SERIALIZER)
+    if index and os.path.exists(records_path(wf, name, index.generation)):
+        os.unlink(records_path(wf, name, index.generation))
+    # records cached as one pickle by earlier versions
+    wf.cache_data(name+'_records', None)
+
+def merge_records(wf, name, fresh):
+    """Add or replace ``fresh`` records, appending only them to the
+    records file - replaced records move to the end, as they always have
+
+    Returns the positions the replaced records had, or None if every
+    record had to be written.
+
+    """
+    key = RECORD_KEYS[name]
+    index = load_record_index(wf, name)
+    path = records_path(wf, name, index.generation) if index else None
+    if not index or not os.path.exists(path):
+        records = load_records(wf, name) or []
+        keys = set(item[key] for item in fresh)
+        records = [item for item in records if item[key] not in keys] + list(fresh)
+        write_records(wf, name, records)
+        return None
+    positions = sorted(i for i in (index.find(item[key]) for item in fresh) if i is not None)
+    dropped = set(positions)
+    kept = [i for i in range(len(index)) if i not in dropped]
+    keys = [index.key(i) for i in kept]
+    offsets = [index.offsets[i] for i in kept]
+    lengths = [index.lengths[i] for i in kept]
+    size = index.data['size']
+    with open(path, 'ab') as f:
+        f.seek(size)
+        f.truncate()
+        for item in fresh:
+            record = pickle.dumps(item, protocol=-1)
+            f.write(record)
+            keys.append(item[key])
+            offsets.append(size)
+            lengths.append(len(record))
+            size += len(record)
+    packed = pack_record_index(index.generation, keys, offsets, lengths, size)
+    wf.cache_data(name+'_ids', packed, serializer=TABLE_SERIALIZER)
+    if packed['size'] > 2 * packed['live']:
+        # mostly replaced records by now - rewrite without them
+        write_records(wf, name, load_records(wf, name))
+    return positions
+
+def append_record_slots(wf, name, index, slots, items):
+    """Write ``items`` to the end of the records file, pointing index
+    positions ``slots`` at them - records keep their place in the order"""
+    keys = [index.key(i) for i in range(len(index))]
+    offsets = list(index.offsets)
+    lengths = list(index.lengths)
+    size = index.data['size']
+    with open(records_path(wf, name, index.generation), 'ab') as f:
+        f.seek(size)
+        f.truncate()
+        for i, item in zip(slots, items):
+            record = pickle.dumps(item, protocol=-1)
+            f.write(record)
+            offsets[i] = size
+            lengths[i] = len(record)
+            size += len(record)
+    return keys, offsets, lengths, size
+
+def patch_records(wf, name, patches):
+    """Apply ``{id: {field: value}}`` to cached records in place
+
+    Returns ``{position: changes}`` for the records found.
+
+    """
+    index = load_record_index(wf, name)
+    if not index:
+        return {}
+    found = {}
+    for key, changes in patches.items():
+        i = index.find(key)
+        if i is not None:
+            found[i] = changes
+    if not found:
+        return {}
+    slots = sorted(found)
+    items = []
+    with open(records_path(wf, name, index.generation), 'rb') as f:
+        for i in slots:
+            f.seek(index.offsets[i])
+            item = pickle.loads(f.read(index.lengths[i]))
+            item.update(found[i])
+            items.append(item)
+    keys, offsets, lengths, size = append_record_slots(wf, name, index, slots, items)
+    wf.cache_data(name+'_ids', pack_record_index(index.generation, keys, offsets, lengths, size), serializer=TABLE_SERIALIZER)
+    return found
+
+def remove_records(wf, name, removed):
+    """Drop the records with ids in ``removed``, returning their positions"""
+    index = load_record_index(wf, name)
+    if not index:
+        return []
+    positions = sorted(i for i in (index.find(key) for key in removed) if i is not None)
+    if not positions:
+        return []
+    dropped = set(positions)
+    kept = [i for i in range(len(index)) if i not in dropped]
+    packed = pack_record_index(index.generation, [index.key(i) for i in kept],
+                               [index.offsets[i] for i in kept], [index.lengths[i] for i in kept], index.data['size'])
+    wf.cache_data(name+'_ids', packed, serializer=TABLE_SERIALIZER)
+    if packed['size'] > 2 * packed['live']:
+        write_records(wf, name, load_records(wf, name))
+    return positions
+
+def unpack_columns(data):
+    """Columns of a packed table as plain (states, values) lists"""
+    columns = {}
+    for name, column in data['columns'].items():
+        if 'str' == column['kind']:
+            strings = StringColumn(*column['values'])
+            values = [strings[i] for i in range(len(strings))]
+        elif 'bool' == column['kind']:
+            values = [bool(value) for value in column['values']]
+        else:
+            values = list(column['values'])
+        states = list(column['states']) if column['states'] is not None else [PRESENT] * data['count']
+        columns[name] = (states, values)
+    return columns
+
+def patch_table(wf, name, found, positions, added=()):
+    """Patch changed cells, drop removed rows and append ``added`` items
+    to a cached table - False if there is no table to change"""
+    data = wf.cached_data(name, max_age=0, serializer=TABLE_SERIALIZER)
+    if not data:
+        return False
+    columns = unpack_columns(data)
+    for i, changes in found.items():
+        for field, value in changes.items():
+            if field in columns:
+                states, values = columns[field]
+                states[i], values[i] = (NONE, None) if value is None else (PRESENT, value)
+    dropped = set(positions)
+    count = data['count'] - len(dropped)
+    rows = unpack_columns(pack_table(added, name)) if added else {}
+    packed = {}
+    for field in set(columns) | set(rows):
+        states, values = columns[field] if field in columns else ([MISSING] * data['count'], [None] * data['count'])
+        if dropped:
+            states = [state for i, state in enumerate(states) if i not in dropped]
+            values = [value for i, value in enumerate(values) if i not in dropped]
+        if added:
+            more_states, more_values = rows[field] if field in rows else ([MISSING] * len(added), [None] * len(added))
+            states, values = states + more_states, values + more_values
+        packed[field] = pack_column(states, values)
+    wf.cache_data(name, {'count': count + len(added), 'columns': packed}, serializer=TABLE_SERIALIZER)
+    return True
+
+def update_index_rows(wf, name, positions, added=()):
+    """Remove rows from a cached search index, renumbering the rest, and
+    append rows with the postings keys in ``added``"""
+    index = wf.cached_data(name+'_index', max_age=0, serializer=TABLE_SERIALIZER)
+    if not index or not (positions or added):
+        return
+    dropped = set(positions)
+    count = index['count'] - len(dropped)
+    fresh = {}
+    for i, keys in enumerate(added):
+        for gram in keys:
+            fresh.setdefault(gram, []).append(count + i)
+    grams = StringColumn(*index['grams'])
+    where = {grams[g]: g for g in range(len(grams))}
+    starts = index['starts']
+    kept_grams = []
+    kept_starts = array('I', [0])
+    flat = array('I')
+    for gram in sorted(set(where) | set(fresh)):
+        if gram in where:
+            g = where[gram]
+            for position in index['postings'][starts[g]:starts[g+1]]:
+                if position not in dropped:
+                    flat.append(position - bisect_left(positions, position))
+        # appended rows come after every other, keeping postings sorted
+        flat.extend(fresh.get(gram, []))
+        if len(flat) > kept_starts[-1]:
+            kept_grams.append(gram)
+            kept_starts.append(len(flat))
+    kept_grams = StringColumn.pack(kept_grams)
+    packed = {'count': count + len(added), 'grams': (kept_grams.offsets, kept_grams.blob), 'starts': kept_starts, 'postings': flat}
+    wf.cache_data(name+'_index', packed, serializer=TABLE_SERIALIZER)
+
+def get_record(wf, name, key):
+    """One record of a collection by id, without loading the others"""
+    index = load_record_index(wf, name)
+    if not index:
+        records = load_records(wf, name) or []
+        return next((x for x in records if str(key) == str(x[RECORD_KEYS[name]])), None)
+    i = index.find(key)
+    if i is None:
+        return None
+    with open(records_path(wf, name, index.generation), 'rb') as f:
+        f.seek(index.offsets[i])
+        return pickle.loads(f.read(index.lengths[i]))
+
+def load_records(wf, name):
+    """Full records of a cached collection, in order"""
+    index = load_record_index(wf, name)
+    if index and os.path.exists(records_path(wf, name, index.generation)):
+        with open(records_path(wf, name, index.generation), 'rb') as f:
+            data = f.read()
+        return [pickle.loads(data[index.offsets[i]:index.offsets[i]+index.lengths[i]]) for i in range(len(index))]
+    # cached before records had an id index
+    records = wf.cached_data(name+'_records', max_age=0)
+    if records is None:
+        records = wf.cached_data(name, max_age=0)
+        records = records if isinstance(records, list) else None
+    return records
+
+
+class CacheSession(object):
+    """The caches as one command.py run sees them
+
+    Collections are loaded at most once, changes are kept in memory and
+    :meth:`flush` writes each changed cache once, calling ``on_write``
+    with every collection written in full. Merged records are appended,
+    and ``on_merge`` is called with the positions they replaced and the
+    records themselves - if it returns False, ``on_write`` gets the whole
+    collection instead. Patched or removed records are written in place,
+    along with their table rows and index entries. ``stats`` counts loads
+    from disk, loads avoided and caches written.
+
+    """
+
+    def __init__(self, wf, on_write=None, on_merge=None):
+        self.wf = wf
+        self.on_write = on_write
+        self.on_merge = on_merge
+        self.records = {}
+        self.by_key = {}
+        self.found = {}
+        self.data = {}
+        self.replaced = set()
+        self.merged = {}
+        self.patched = {}
+        self.removed = {}
+        self.changed = set()
+        self.stats = {'loaded': 0, 'avoided': 0, 'written': 0}
+
+    def load(self, name):
+        """Every record of collection ``name``, in order"""
+        if name in self.records:
+            self.stats['avoided'] += 1
+        else:
+            self.stats['loaded'] += 1
+            self.records[name] = load_records(self.wf, name)
+        return self.records[name]
+
+    def get(self, name, key):
+        """One record of collection ``name`` by id"""
+        key = str(key)
+        if self.records.get(name) is not None:
+            self.stats['avoided'] += 1
+            if name not in self.by_key:
+                field = RECORD_KEYS[name]
+                self.by_key[name] = {str(x[field]): x for x in self.records[name]}
+            return self.by_key[name].get(key)
+        if (name, key) in self.found:
+            self.stats['avoided'] += 1
+        else:
+            self.stats['loaded'] += 1
+            self.found[(name, key)] = get_record(self.wf, name, key)
+        return self.found[(name, key)]
+
+    def store(self, name, items):
+        """Replace collection ``name`` with ``items``"""
+        self.records[name] = items
+        self.by_key.pop(name, None)
+        self.found = {k: v for k, v in self.found.items() if k[0] != name}
+        self.replaced.add(name)
+        self.merged.pop(name, None)
+
+    def merge(self, name, fresh):
+        """Add or replace ``fresh`` records of collection ``name``"""
+        field = RECORD_KEYS[name]
+        keys = set(item[field] for item in fresh)
+        if self.records.get(name) is not None:
+            self.records[name] = [item for item in self.records[name] if item[field] not in keys] + list(fresh)
+            self.by_key.pop(name, None)
+        for item in fresh:
+            self.found[(name, str(item[field]))] = item
+        if name not in self.replaced:
+            # a record merged again moves to the end, once
+            merged = self.merged.setdefault(name, {})
+            for item in fresh:
+                merged.pop(item[field], None)
+                merged[item[field]] = item
+
+    def patch(self, name, key, changes):
+        """Change some fields of one record of collection ``name``"""
+        if name in self.replaced or name in self.merged:
+            # written in full anyway
+            record = self.get(name, key)
+            if record is not None:
+                self.merge(name, [dict(record, **changes)])
+            return
+        self.patched.setdefault(name, {}).setdefault(key, {}).update(changes)
+        self.update_loaded(name, key, lambda record: dict(record, **changes))
+
+    def remove(self, name, key):
+        """Drop one record of collection ``name``"""
+        if name in self.replaced:
+            # written in full anyway
+            field = RECORD_KEYS[name]
+            self.store(name, [x for x in self.records[name] if str(x[field]) != str(key)])
+            return
+        if name in self.merged:
+            # merged records are written first, then removals apply to them
+            self.merged[name] = {k: v for k, v in self.merged[name].items() if str(k) != str(key)}
+        self.removed.setdefault(name, set()).add(key)
+        self.update_loaded(name, key, lambda record: None)
+
+    def update_loaded(self, name, key, change):
+        key = str(key)
+        field = RECORD_KEYS[name]
+        if self.records.get(name) is not None:
+            records = [change(x) if str(x[field]) == key else x for x in self.records[name]]
+            self.records[name] = [x for x in records if x is not None]
+            self.by_key.pop(name, None)
+        if (name, key) in self.found and self.found[(name, key)] is not None:
+            self.found[(name, key)] = change(self.found[(name, key)])
+
+    def cached_data(self, name):
+        """Any other cache, as :meth:`Workflow.cached_data` with no max age"""
+        if name in self.data:
+            self.stats['avoided'] += 1
+        else:
+            self.stats['loaded'] += 1
+            self.data[name] = self.wf.cached_data(name, max_age=0)
+        return self.data[name]
+
+    def cache_data(self, name, data):
+        self.data[name] = data
+        self.changed.add(name)
+
+    def flush(self):
+        """Write every changed cache, returning the collections written in
+        full or merged"""
+        written = []
+        for name in sorted(self.replaced):
+            write_records(self.wf, name, self.records[name])
+            written.append((name, self.records[name]))
+        merged = []
+        for name, fresh in sorted(self.merged.items()):
+            fresh = list(fresh.values())
+            if not fresh:
+                continue
+            positions = merge_records(self.wf, name, fresh)
+            if positions is not None and self.on_merge and self.on_merge(self.wf, name, positions, fresh):
+                merged.append(name)
+            else:
+                written.append((name, load_records(self.wf, name)))
+        for name, records in written:
+            if self.on_write:
+                self.on_write(self.wf, name, records)
+        patched = 0
+        for name in sorted(set(self.patched) | set(self.removed)):
+            found = patch_records(self.wf, name, self.patched.get(name, {}))
+            positions = remove_records(self.wf, name, self.removed.get(name, set()))
+            if found or positions:
+                patch_table(self.wf, name, found, positions)
+                update_index_rows(self.wf, name, positions)
+                patched += 1
+        # caches that describe the collections go last
+        for name in sorted(self.changed):
+            self.wf.cache_data(name, self.data[name])
+        self.stats['written'] += len(written) + len(merged) + patched + len(self.changed)
+        self.replaced, self.merged, self.changed = set(), {}, set()
+        self.patched, self.removed = {}, {}
+        return [name for name, records in written] + merged
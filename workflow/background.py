@@ -12,7 +12,6 @@ and examples.
 import os
 import pickle
 import signal
-import subprocess
 import sys
 
 from workflow import Workflow
@@ -214,6 +213,8 @@ def run_in_background(name, args, **kwargs):
         wf.logger.debug("[%s] command cached: %s", name, argcache)
 
     # Call this script
+    import subprocess
+
     cmd = ["/usr/bin/python3", "-m", "workflow.background", name]
     wf.logger.debug("[%s] passing job to background runner: %r", name, cmd)
     retcode = subprocess.run(cmd, check=True).returncode
@@ -260,6 +261,8 @@ def main(wf):  # pragma: no cover  # pylint: disable=redefined-outer-name
         # Run the command
         wf.logger.debug("[%s] running command: %r", name, args)
 
+        import subprocess
+
         retcode = subprocess.run(args, **kwargs, check=True).returncode
 
         if retcode:
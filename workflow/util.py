@@ -9,7 +9,6 @@ import functools
 import json
 import os
 import signal
-import subprocess
 import sys
 import time
 from collections import namedtuple
@@ -98,6 +97,8 @@ def run_command(cmd, **kwargs):
         str: Output returned by :func:`~subprocess.check_output`.
 
     """
+    import subprocess
+
     cmd = [str(s) for s in cmd]
     return subprocess.check_output(cmd, **kwargs).decode()
 
@@ -1,13 +1,19 @@
 """Lightweight HTTP library with a requests-like interface."""
 
+import base64
 import codecs
+import http.client
+import io
 import json
 import mimetypes
 import os
 import re
 import secrets
+import select
 import socket
 import string
+import threading
+import time
 import unicodedata
 import urllib.request
 import urllib.parse
@@ -24,6 +30,15 @@ USER_AGENT = f"Alpynist/{__version__}"
 # Valid characters for multipart form data boundaries
 BOUNDARY_CHARS = string.digits + string.ascii_letters
 
+# Seconds an unused keep-alive connection stays in a :class:`Session` pool
+IDLE_TIMEOUT = 30
+
+# Redirects a :class:`Session` will follow before giving up
+MAX_REDIRECTS = 5
+
+# Methods a :class:`Session` sends again when a reused connection turns out closed
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
 # HTTP response codes
 RESPONSES = {
     100: "Continue",
@@ -183,12 +198,17 @@ class Response:
 
     """
 
-    def __init__(self, request, stream=False):  # pylint: disable=redefined-outer-name
+    def __init__(
+        self, request, stream=False, opener=None
+    ):  # pylint: disable=redefined-outer-name
         """Call `request` with :mod:`urllib` and process results.
 
         :param request: :class:`Request` instance
         :param stream: Whether to stream response or retrieve it all at once
         :type stream: bool
+        :param opener: callable used instead of :func:`urllib.request.urlopen`
+            to open ``request``, e.g. :meth:`Session.urlopen`
+        :type opener: callable
 
         """
         self.request = request
@@ -207,9 +227,11 @@ class Response:
         # Execute query
         try:
             # pylint: disable=consider-using-with
-            self.raw = urllib.request.urlopen(request)
+            self.raw = (opener or urllib.request.urlopen)(request)
         except urllib.error.HTTPError as err:
             self.error = err
+            # the error body, e.g. an API's JSON error message, stays readable
+            self.raw = err
 
             try:
                 self.url = err.geturl()
@@ -226,8 +248,8 @@ class Response:
             self.url = self.raw.geturl()
         self.reason = RESPONSES.get(self.status_code)
 
-        # Parse additional info if request succeeded
-        if not self.error:
+        # Parse additional info, also of error responses (e.g. Retry-After)
+        if self.raw.info() is not None:
             headers = self.raw.info()
             self.transfer_encoding = headers.get_content_charset()
             self.mimetype = headers.get("content-type")
@@ -270,6 +292,32 @@ class Response:
         """
         return json.loads(self.content)
 
+    def iter_json(self, key=None, rest=None, chunk_size=16384):
+        """Decode a JSON array incrementally, yielding its elements as
+        they arrive instead of loading the whole body first.
+
+        The array is either the whole document or, with ``key``, the
+        member ``key`` of a top-level object. The object's other
+        members are stored in ``rest`` if it is a :class:`dict`. The
+        body is read to the end, so a pooled connection goes back to
+        its :class:`Session`.
+
+        Only available if the response was requested with
+        ``stream=True``.
+
+        :param key: member holding the array, or ``None``
+        :type key: str
+        :param rest: receives the other members of the top-level object
+        :type rest: dict
+        :param chunk_size: Number of bytes to read at a time
+        :type chunk_size: int
+        :returns: iterator
+
+        """
+        return _JSONArrayReader(
+            self.iter_content(chunk_size), self.encoding or "utf-8"
+        ).items(key, rest)
+
     @property
     def encoding(self):
         """Text encoding of document or ``None``.
@@ -448,6 +496,104 @@ class Response:
         return encoding
 
 
+# Characters a JSON number can go on with, e.g. the "5" after "1."
+_NUMBER_CHARS = "0123456789.eE+-"
+
+
+class _JSONArrayReader:
+    """Pull parser for :meth:`Response.iter_json`."""
+
+    def __init__(self, chunks, encoding):
+        self.chunks = chunks
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self.json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """Read the next chunk, returning ``False`` at the end of the body."""
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            data = self.decoder.decode(b"", final=True)
+        else:
+            data = self.decoder.decode(chunk)
+        # drop what has been parsed already
+        self.buf = self.buf[self.pos :] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, or ``""`` at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.more():
+                return self.buf[self.pos : self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"expected one of {chars!r} at {char!r} in JSON")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+                # a value that ends the buffer may be cut short, and so
+                # may a number followed only by what could continue it
+                rest = self.buf[end:]
+                if self.buf[self.pos] in "-0123456789":
+                    rest = rest.lstrip(_NUMBER_CHARS)
+                if rest or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.more()
+
+    def array(self):
+        self.expect("[")
+        if "]" == self.peek():
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if "]" == self.expect(",]"):
+                return
+
+    def items(self, key, rest):
+        if key is None:
+            yield from self.array()
+        else:
+            self.expect("{")
+            if "}" != self.peek():
+                while True:
+                    name = self.value()
+                    self.expect(":")
+                    if name == key and "[" == self.peek():
+                        yield from self.array()
+                    else:
+                        value = self.value()
+                        if rest is not None:
+                            rest[name] = value
+                    if "}" == self.expect(",}"):
+                        break
+            else:
+                self.pos += 1
+        # drain the body so the connection can be reused
+        while self.more():
+            pass
+
+
 def request(
     method,
     url,
@@ -525,6 +671,18 @@ def request(
     opener = urllib.request.build_opener(*openers)
     urllib.request.install_opener(opener)
 
+    req = _build_request(method, url, params, data, json_data, headers, files)
+    return Response(req, stream)
+
+
+def _build_request(method, url, params, data, json_data, headers, files):
+    """Encode headers, body and query string into a :class:`Request`.
+
+    Shared by :func:`request` and :meth:`Session.request`.
+
+    :returns: :class:`Request` instance
+
+    """
     if not headers:
         headers = CaseInsensitiveDictionary()
     else:
@@ -568,8 +726,7 @@ def request(
         query = urllib.parse.urlencode(params, doseq=True)
         url = urllib.parse.urlunsplit((scheme, netloc, path, query, fragment))
 
-    req = Request(url, data, headers, method=method)
-    return Response(req, stream)
+    return Request(url, data, headers, method=method)
 
 
 def get(
@@ -679,6 +836,285 @@ def put(
     )
 
 
+class PooledResponse:
+    """File-like wrapper around :class:`http.client.HTTPResponse`.
+
+    Quacks like the object returned by :func:`urllib.request.urlopen`
+    and hands its connection back to the :class:`Session` it came from
+    as soon as the body has been read to the end.
+
+    """
+
+    def __init__(self, response, url, release):
+        """Wrap ``response`` for ``url``; ``release`` is called at EOF."""
+        self._response = response
+        self._release = release
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def getcode(self):
+        """Return HTTP status code."""
+        return self.status
+
+    def geturl(self):
+        """Return URL of the response."""
+        return self.url
+
+    def info(self):
+        """Return response headers."""
+        return self.headers
+
+    def read(self, amt=None):
+        """Read ``amt`` bytes (or the remaining body) from the response."""
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        """Return the connection to its pool (or drop it if unread)."""
+        if self._release is not None:
+            release = self._release
+            self._release = None
+            release(self._response)
+
+
+def _dropped(conn):
+    """Whether idle connection ``conn`` was closed by the server.
+
+    An idle connection has nothing to read unless the server closed it
+    (or sent something unexpected), so a readable socket is not reused.
+
+    """
+    if conn.sock is None:
+        return True
+
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+
+    return bool(readable)
+
+
+class Session:
+    """Pool of keep-alive HTTP(S) connections, reused across requests.
+
+    Idle connections are kept per ``(scheme, host, port)`` and closed
+    once they have been unused for ``idle_timeout`` seconds. A session
+    is safe to share between threads: each request checks out its own
+    connection and returns it when the response body has been read.
+
+    ``stats`` counts connections ``opened`` and ``reused``.
+
+    Proxies are not supported; use :func:`request` if you need them.
+
+    >>> s = Session()
+    >>> r = s.request('GET', 'https://www.google.com')
+    >>> s.stats
+    {'opened': 1, 'reused': 0}
+
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_idle=10):
+        """Create a new, empty :class:`Session`.
+
+        :param idle_timeout: seconds before an unused connection is closed
+        :type idle_timeout: int
+        :param max_idle: idle connections kept per host
+        :type max_idle: int
+
+        """
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.stats = {"opened": 0, "reused": 0}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def request(
+        self,
+        method,
+        url,
+        params=None,
+        data=None,
+        json_data=None,
+        headers=None,
+        files=None,
+        auth=None,
+        timeout=60,
+        allow_redirects=False,
+        stream=False,
+    ):
+        """Initiate an HTTP(S) request over a pooled connection.
+
+        Arguments and return value as for :func:`request`.
+
+        """
+        if auth is not None:
+            headers = CaseInsensitiveDictionary(headers or {})
+            token = base64.b64encode(":".join(auth).encode("utf-8"))
+            headers["Authorization"] = "Basic " + token.decode("ascii")
+
+        req = _build_request(method, url, params, data, json_data, headers, files)
+
+        def opener(request):  # pylint: disable=redefined-outer-name
+            return self.urlopen(request, timeout, allow_redirects, stream)
+
+        return Response(req, stream, opener=opener)
+
+    def urlopen(self, request, timeout=60, allow_redirects=False, stream=False):
+        """Open :class:`Request` ``request`` on a pooled connection.
+
+        Raises :class:`urllib.error.HTTPError` for 4xx/5xx responses,
+        like :func:`urllib.request.urlopen`.
+
+        :returns: :class:`PooledResponse` instance
+
+        """
+        method = request.get_method()
+        url = request.full_url
+        body = request.data
+        headers = dict(request.header_items())
+
+        for _ in range(MAX_REDIRECTS + 1):
+            raw = self._send(method, url, body, headers, timeout)
+            location = raw.headers.get("location")
+
+            if not (allow_redirects and location and raw.status in (301, 302, 303, 307)):
+                break
+
+            raw.read()
+            url = urllib.parse.urljoin(url, location)
+            if raw.status == 303:
+                method, body = "GET", None
+
+        if raw.status >= 400:
+            content = raw.read()
+            raise urllib.error.HTTPError(
+                url, raw.status, raw.reason, raw.headers, io.BytesIO(content)
+            )
+
+        if not stream:  # read now so the connection goes straight back
+            content = raw.read()
+            raw = PooledResponse(_BufferedResponse(raw, content), url, None)
+
+        return raw
+
+    def _send(self, method, url, body, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+        conn, reused = self._acquire(key, timeout)
+        sent = False
+        try:
+            conn.request(method, path, body, headers)
+            sent = True
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            conn.close()
+            # the server may have acted on a request it got before the
+            # connection dropped, so only safe requests are sent again
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+            # server dropped the idle keep-alive connection: retry on a new one
+            conn, reused = self._connect(key, timeout), False
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+
+        return PooledResponse(
+            response, url, lambda r: self._release(key, conn, r)
+        )
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+        with self._lock:
+            self.stats["opened"] += 1
+
+        return conn
+
+    def _acquire(self, key, timeout):
+        now = time.time()
+        conn = None
+        stale = []
+
+        with self._lock:
+            conns = self._idle.get(key, [])
+            while conns and conn is None:
+                candidate, last_used = conns.pop()
+                if now - last_used > self.idle_timeout or _dropped(candidate):
+                    stale.append(candidate)
+                else:
+                    conn = candidate
+            if conn is not None:
+                self.stats["reused"] += 1
+
+        for candidate in stale:
+            candidate.close()
+
+        if conn is None:
+            return self._connect(key, timeout), False
+
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+        return conn, True
+
+    def _release(self, key, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append((conn, time.time()))
+                return
+
+        conn.close()
+
+
+class _BufferedResponse:
+    """Stand-in for an already-read :class:`http.client.HTTPResponse`."""
+
+    will_close = False
+
+    def __init__(self, response, content):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.headers
+        self._body = io.BytesIO(content)
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def isclosed(self):
+        return False
+
+
 def _encode_multipart_formdata(fields, files):
     """Encode form data (``fields``) and ``files`` for POST request.
 
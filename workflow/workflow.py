@@ -12,23 +12,19 @@ up your Python script to best utilise the :class:`Workflow` object.
 """
 
 import binascii
+import heapq
 import json
 import logging
 import logging.handlers
 import os
 import pickle
-import plistlib
 import re
-import shutil
 import string
-import subprocess
 import sys
 import time
 import unicodedata
 from contextlib import contextmanager
 from copy import deepcopy
-from typing import Optional
-from uuid import uuid4
 
 from .util import atomic_writer, LockFile, uninterruptible, set_config
 
@@ -348,6 +344,17 @@ INITIALS = string.ascii_uppercase + string.digits
 #: Split on non-letters, numbers
 split_on_delimiters = re.compile("[^a-zA-Z0-9]").split
 
+#: Highest score one query word can add to an item
+MAX_WORD_SCORE = 100.0
+
+# Slack on score bounds, so float rounding can never prune a match
+_BOUND_SLACK = 1 + 1e-9
+
+# Bits of :func:`char_mask`: one per letter and digit, the rest shared.
+# 63 bits, so masks fit signed 64-bit integers
+_MASK_BITS = {c: 1 << i for i, c in enumerate(string.ascii_lowercase + string.digits)}
+_MASK_SHARED = 63 - len(_MASK_BITS)
+
 # Match filter flags
 #: Match items that start with ``query``
 MATCH_STARTSWITH = 1
@@ -429,6 +436,124 @@ def isascii(text):
     return True
 
 
+def char_mask(chars):
+    """Bitmask of the characters in ``chars``, below ``2 ** 63``.
+
+    Lower-case letters and digits have a bit each; other characters
+    share the remaining bits. A key holding every character of a query
+    always has every bit of the query's mask set, but the reverse only
+    proves it when the query is all letters and digits (see
+    :func:`mask_is_exact`).
+
+    :param chars: (lower-case) characters
+    :type chars: ``str`` or ``set``
+    :returns: bitmask
+    :rtype: ``int``
+
+    """
+    mask = 0
+    for c in chars:
+        bit = _MASK_BITS.get(c)
+        if bit is None:
+            bit = 1 << (len(_MASK_BITS) + ord(c) % _MASK_SHARED)
+        mask |= bit
+    return mask
+
+
+def mask_is_exact(chars):
+    """Whether :func:`char_mask` tells exactly if a key holds ``chars``."""
+    return all(c in _MASK_BITS for c in chars)
+
+
+def search_fields(value):
+    """Precompute everything :meth:`Workflow.filter` derives from a search key.
+
+    Pass a function returning these to :meth:`Workflow.filter` as
+    ``search_fields`` to avoid re-deriving them on every query. The
+    result only holds strings, numbers, lists and sets, so it can be
+    cached.
+
+    :param value: search key
+    :type value: ``str``
+    :returns: ``dict`` of derived fields
+    :rtype: ``dict``
+
+    """
+    value = value.strip() if value else ""
+    folded = Workflow.fold_to_ascii(value)
+    atoms = [s.lower() for s in split_on_delimiters(folded)]
+    return {
+        "value": value,
+        "lower": value.lower(),
+        "ascii": isascii(value),
+        "folded": folded,
+        "folded_lower": folded.lower(),
+        "atoms": atoms,
+        "initials": "".join([s[0] for s in atoms if s]),
+        "capitals": "".join([c for c in folded if c in INITIALS]).lower(),
+        "chars": frozenset(folded.lower()),
+        "mask": char_mask(folded.lower()),
+    }
+
+
+class _Worst:
+    """Heap entry that puts the worst-ranked result on top."""
+
+    __slots__ = ("key", "result")
+
+    def __init__(self, key, result):
+        self.key = key
+        self.result = result
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+class _TopResults:
+    """The ``size`` best ``(sort key, (item, score, rule))`` pairs.
+
+    Keeps a bounded heap, so ranking ``n`` matches costs ``O(n log size)``
+    instead of sorting them all. Ties rank in insertion order, as with a
+    stable sort.
+
+    """
+
+    def __init__(self, size, min_score=0):
+        self.size = size
+        self.min_score = min_score
+        self.heap = []
+        self.count = 0
+
+    def hopeless(self, bound):
+        """Whether a result scoring at most ``bound`` cannot be kept."""
+        # very long keys score below zero and then rank first, unless
+        # ``min_score`` drops them, so only prune when it does
+        if self.min_score <= 0:
+            return False
+
+        bound *= _BOUND_SLACK
+        if bound <= self.min_score:
+            return True
+
+        return len(self.heap) >= self.size and 100.0 / bound > self.heap[0].key[0][0]
+
+    def add(self, key, result):
+        if self.min_score and result[1] <= self.min_score:
+            return
+
+        entry = _Worst((key, self.count), result)
+        self.count += 1
+
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif entry.key < self.heap[0].key:
+            heapq.heapreplace(self.heap, entry)
+
+    def results(self):
+        """Kept results, best first."""
+        return [entry.result for entry in sorted(self.heap, key=lambda x: x.key)]
+
+
 ####################################################################
 # Implementation classes
 ####################################################################
@@ -510,10 +635,22 @@ class SerializerManager:
         return sorted(self._serializers.keys())
 
 
+def _open(*args):
+    """Run ``/usr/bin/open`` with ``args``.
+
+    :mod:`subprocess` is only imported when needed, to keep the
+    workflow's startup short.
+
+    """
+    import subprocess
+
+    subprocess.run(["/usr/bin/open"] + list(args), check=True)
+
+
 class BaseSerializer:
     """Base class for serializers."""
 
-    is_binary: Optional[bool] = None
+    is_binary: "bool | None" = None
 
     @classmethod
     def binary_mode(cls):  # pylint: disable=missing-function-docstring
@@ -1194,6 +1331,8 @@ class Workflow:
         self._last_version_run = UNSET
         # Cache for regex patterns created for filter keys
         self._search_pattern_cache = {}
+        # Cache for (char mask, exact) of filter query words
+        self._query_mask_cache = {}
         #: Prefix for all magic arguments.
         #: The default value is ``workflow:`` so keyword
         #: ``config`` would match user query ``workflow:config``.
@@ -1878,7 +2017,7 @@ class Workflow:
 
         self.logger.debug("saved data: %s", data_path)
 
-    def cached_data(self, name, data_func=None, max_age=60):
+    def cached_data(self, name, data_func=None, max_age=60, serializer=None):
         """Return cached data if younger than ``max_age`` seconds.
 
         Retrieve data from cache or re-generate and re-cache data if
@@ -1890,14 +2029,17 @@ class Workflow:
         :type data_func: ``callable``
         :param max_age: maximum age of cached data in seconds
         :type max_age: ``int``
+        :param serializer: name of serializer to use. If no serializer
+            is specified, :attr:`cache_serializer` is used.
         :returns: cached data, return value of ``data_func`` or ``None``
             if ``data_func`` is not set
 
         """
-        serializer = manager.serializer(self.cache_serializer)
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
 
-        cache_path = self.cachefile(f"{name}.{self.cache_serializer}")
-        age = self.cached_data_age(name)
+        cache_path = self.cachefile(f"{name}.{serializer_name}")
+        age = self.cached_data_age(name, serializer_name)
 
         if (age < max_age or max_age == 0) and os.path.exists(cache_path):
             with open(cache_path, "rb") as file_obj:
@@ -1908,11 +2050,11 @@ class Workflow:
             return None
 
         data = data_func()
-        self.cache_data(name, data)
+        self.cache_data(name, data, serializer_name)
 
         return data
 
-    def cache_data(self, name, data):
+    def cache_data(self, name, data, serializer=None):
         """Save ``data`` to cache under ``name``.
 
         If ``data`` is ``None``, the corresponding cache file will be
@@ -1921,11 +2063,20 @@ class Workflow:
         :param name: name of datastore
         :param data: data to store. This may be any object supported by
                 the cache serializer
+        :param serializer: name of serializer to use. If no serializer
+            is specified, :attr:`cache_serializer` is used.
 
         """
-        serializer = manager.serializer(self.cache_serializer)
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
 
-        cache_path = self.cachefile(f"{name}.{self.cache_serializer}")
+        if serializer is None:
+            raise ValueError(
+                f"Invalid serializer `{serializer_name}`. "
+                "Register your serializer with `manager.register()` first."
+            )
+
+        cache_path = self.cachefile(f"{name}.{serializer_name}")
 
         if data is None:
             if os.path.exists(cache_path):
@@ -1939,33 +2090,36 @@ class Workflow:
 
         self.logger.debug("cached data: %s", cache_path)
 
-    def cached_data_fresh(self, name, max_age):
+    def cached_data_fresh(self, name, max_age, serializer=None):
         """Whether cache `name` is less than `max_age` seconds old.
 
         :param name: name of datastore
         :param max_age: maximum age of data in seconds
         :type max_age: ``int``
+        :param serializer: name of serializer the cache was saved with
         :returns: ``True`` if data is less than ``max_age`` old, else
             ``False``
 
         """
-        age = self.cached_data_age(name)
+        age = self.cached_data_age(name, serializer)
 
         if not age:
             return False
 
         return age < max_age
 
-    def cached_data_age(self, name):
+    def cached_data_age(self, name, serializer=None):
         """Return age in seconds of cache `name` or 0 if cache doesn't exist.
 
         :param name: name of datastore
         :type name: ``str``
+        :param serializer: name of serializer the cache was saved with
+        :type serializer: ``str``
         :returns: age of datastore in seconds
         :rtype: ``int``
 
         """
-        cache_path = self.cachefile(f"{name}.{self.cache_serializer}")
+        cache_path = self.cachefile(f"{name}.{serializer or self.cache_serializer}")
 
         if not os.path.exists(cache_path):
             return 0
@@ -1983,6 +2137,7 @@ class Workflow:
         max_results=0,
         match_on=MATCH_ALL,
         fold_diacritics=True,
+        search_fields=None,
     ):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
@@ -2010,6 +2165,9 @@ class Workflow:
             than this.
         :type min_score: ``int``
         :param max_results: If non-zero, prune results list to this length.
+            Unless ``ascending`` is set, only the best ``max_results``
+            matches are kept while filtering, and items stop being scored
+            as soon as they can no longer make the cut.
         :type max_results: ``int``
         :param match_on: Filter option flags. Bitwise-combined list of
             ``MATCH_*`` constants (see below).
@@ -2017,6 +2175,9 @@ class Workflow:
         :param fold_diacritics: Convert search keys to ASCII-only
             characters if ``query`` only contains ASCII characters.
         :type fold_diacritics: ``Boolean``
+        :param search_fields: function to get precomputed fields (see
+            :func:`search_fields`) from ``items``. Used instead of ``key``.
+        :type search_fields: ``callable``
         :returns: list of ``items`` matching ``query`` or list of
             ``(item, score, rule)`` `tuples` if ``include_score`` is ``True``.
             ``rule`` is the ``MATCH_*`` rule that matched the item.
@@ -2095,27 +2256,35 @@ class Workflow:
         )
 
         results = []
+        words = [s.strip() for s in query.split(" ")]
+        words = [word for word in words if word]
+        # only the best matches are kept, so hopeless items can be dropped early
+        top = _TopResults(max_results, min_score) if max_results and not ascending else None
 
         for item in items:
             skip = False
             score = 0
-            words = [s.strip() for s in query.split(" ")]
-            value = key(item).strip()
+            fields = search_fields(item) if search_fields else None
+            value = fields["value"] if fields else key(item).strip()
 
             if value == "":
                 continue
 
-            for word in words:
-                if word == "":
-                    continue
-
-                score_, rule = self._filter_item(value, word, match_on, fold_diacritics)
+            for i, word in enumerate(words):
+                score_, rule = self._filter_item(
+                    value, word, match_on, fold_diacritics, fields
+                )
 
                 if not score_:  # Skip items that don't match part of the query
                     skip = True
+                    break
 
                 score += score_
 
+                if top and top.hopeless(score + MAX_WORD_SCORE * (len(words) - i - 1)):
+                    skip = True
+                    break
+
             if skip:
                 continue
 
@@ -2123,10 +2292,116 @@ class Workflow:
                 # use "reversed" `score` (i.e. highest becomes lowest) and
                 # `value` as sort key. This means items with the same score
                 # will be sorted in alphabetical not reverse alphabetical order
-                results.append(
-                    ((100.0 / score, value.lower(), score), (item, score, rule))
+                lower = fields["lower"] if fields else value.lower()
+                if top:
+                    top.add((100.0 / score, lower, score), (item, score, rule))
+                else:
+                    results.append(((100.0 / score, lower, score), (item, score, rule)))
+
+        if top:
+            return self._unwrap_results(top.results(), include_score)
+
+        return self._rank_results(
+            results, ascending, include_score, min_score, max_results
+        )
+
+    def filter_prefixes(
+        self,
+        query,
+        items,
+        key=lambda x: x,
+        prefixes=1,
+        ascending=False,
+        include_score=False,
+        min_score=0,
+        max_results=0,
+        match_on=MATCH_ALL,
+        fold_diacritics=True,
+        search_fields=None,
+    ):
+        """Fuzzy search ``items`` for ``query`` and its shorter word prefixes.
+
+        Equivalent to calling :meth:`filter` with ``query``, then with
+        ``query`` minus its last word, and so on for up to ``prefixes``
+        dropped words, but each item is scored only once: an item's
+        score for a prefix is the sum of its first words' scores.
+
+        Arguments are as for :meth:`filter`.
+
+        :param prefixes: number of trailing words to drop, one at a time
+        :type prefixes: ``int``
+        :returns: list of ``prefixes + 1`` result lists, for ``query``
+            first. Prefixes with no words left get an empty list.
+        :rtype: ``list``
+
+        """
+        words = [s.strip() for s in query.split(" ")] if query else []
+        words = [word for word in words if word]
+
+        if not words:
+            return [items] + [[] for _ in range(prefixes)]
+
+        fold_diacritics = self.settings.get(
+            "__workflow_diacritic_folding", fold_diacritics
+        )
+
+        # word counts of the queries, longest first
+        lengths = [len(words) - i for i in range(prefixes + 1)]
+        results = [[] for _ in lengths]
+
+        for item in items:
+            fields = search_fields(item) if search_fields else None
+            value = fields["value"] if fields else key(item).strip()
+
+            if value == "":
+                continue
+
+            scores = []
+            rules = []
+            lower = fields["lower"] if fields else value.lower()
+
+            for word in words:
+                score_, rule = self._filter_item(
+                    value, word, match_on, fold_diacritics, fields
+                )
+
+                # no longer query containing this word can match the item
+                if not score_:
+                    break
+
+                scores.append(score_)
+                rules.append(rule)
+
+            for i, length in enumerate(lengths):
+                if length < 1 or length > len(scores):
+                    continue
+
+                score = sum(scores[:length])
+
+                if not score:
+                    continue
+
+                results[i].append(
+                    ((100.0 / score, lower, score), (item, score, rules[length - 1]))
                 )
 
+        return [
+            self._rank_results(found, ascending, include_score, min_score, max_results)
+            if length > 0
+            else []
+            for found, length in zip(results, lengths)
+        ]
+
+    @staticmethod
+    def _rank_results(results, ascending, include_score, min_score, max_results):
+        """Sort, prune and unwrap ``(sort key, (item, score, rule))`` pairs."""
+        if max_results and not ascending:
+            # select the best without sorting the rest
+            top = _TopResults(max_results, min_score)
+            for key, result in results:
+                top.add(key, result)
+            return Workflow._unwrap_results(top.results(), include_score)
+
         # sort on keys, then discard the keys
         results.sort(key=lambda x: x[0], reverse=ascending)
         results = [result[1] for result in results]
@@ -2137,6 +2412,11 @@ class Workflow:
         if max_results and len(results) > max_results:
             results = results[:max_results]
 
+        return Workflow._unwrap_results(results, include_score)
+
+    @staticmethod
+    def _unwrap_results(results, include_score):
+        """``(item, score, rule)`` tuples, or just the items."""
         # return list of ``(item, score, rule)``
         if include_score:
             return results
@@ -2144,7 +2424,7 @@ class Workflow:
         # just return list of items
         return [result[0] for result in results]
 
-    def _filter_item(self, value, query, match_on, fold_diacritics):
+    def _filter_item(self, value, query, match_on, fold_diacritics, fields=None):
         """Filter ``value`` against ``query`` using rules ``match_on``.
 
         :returns: ``(score, rule)``
@@ -2155,6 +2435,10 @@ class Workflow:
         if not isascii(query):
             fold_diacritics = False
 
+        # precomputed fields are folded, which is a no-op on ASCII keys
+        if fields is not None and (fold_diacritics or fields["ascii"]):
+            return self._filter_fields(fields, query, match_on)
+
         if fold_diacritics:
             value = self.fold_to_ascii(value)
 
@@ -2230,6 +2514,56 @@ class Workflow:
         # Nothing matched
         return (0, None)
 
+    def _filter_fields(self, fields, query, match_on):
+        """Same rules as :meth:`_filter_item`, on :func:`search_fields` output.
+
+        :returns: ``(score, rule)``
+
+        """
+        value = fields["folded"]
+        lower = fields["folded_lower"]
+
+        query_mask = self._query_mask_cache.get(query)
+        if query_mask is None:
+            query_mask = (char_mask(query), mask_is_exact(query))
+            self._query_mask_cache[query] = query_mask
+
+        # keys cached without a mask only have their set of characters
+        mask = fields.get("mask")
+        if mask is None or not query_mask[1]:
+            if not set(query) <= fields["chars"]:
+                return (0, None)
+        elif mask & query_mask[0] != query_mask[0]:
+            return (0, None)
+
+        if match_on & MATCH_STARTSWITH and lower.startswith(query):
+            return (100.0 - (len(value) / len(query)), MATCH_STARTSWITH)
+
+        if match_on & MATCH_CAPITALS and fields["capitals"].startswith(query):
+            return (100.0 - (len(fields["capitals"]) / len(query)), MATCH_CAPITALS)
+
+        initials = fields["initials"]
+
+        if match_on & MATCH_ATOM and query in fields["atoms"]:
+            return (100.0 - (len(value) / len(query)), MATCH_ATOM)
+
+        if match_on & MATCH_INITIALS_STARTSWITH and initials.startswith(query):
+            return (100.0 - (len(initials) / len(query)), MATCH_INITIALS_STARTSWITH)
+
+        if match_on & MATCH_INITIALS_CONTAIN and query in initials:
+            return (95.0 - (len(initials) / len(query)), MATCH_INITIALS_CONTAIN)
+
+        if match_on & MATCH_SUBSTRING and query in lower:
+            return (90.0 - (len(value) / len(query)), MATCH_SUBSTRING)
+
+        if match_on & MATCH_ALLCHARS:
+            match = self._search_for_query(query)(value)
+            if match:
+                score = 100.0 / ((1 + match.start()) * (match.end() - match.start() + 1))
+                return (score, MATCH_ALLCHARS)
+
+        return (0, None)
+
     def _search_for_query(self, query):
         if query in self._search_pattern_cache:
             return self._search_pattern_cache[query]
@@ -2351,6 +2685,8 @@ class Workflow:
 
         """
         if not self._session_id:
+            from uuid import uuid4
+
             self._session_id = uuid4().hex
             self.setvar("_WF_SESSION_ID", self._session_id)
 
@@ -2971,29 +3307,27 @@ class Workflow:
 
     def open_log(self):
         """Open :attr:`logfile` in default app (usually Console.app)."""
-        subprocess.run(["/usr/bin/open", self.logfile], check=True)
+        _open(self.logfile)
 
     def open_cachedir(self):
         """Open the workflow's :attr:`cachedir` in Finder."""
-        subprocess.run(["/usr/bin/open", self.cachedir], check=True)
+        _open(self.cachedir)
 
     def open_datadir(self):
         """Open the workflow's :attr:`datadir` in Finder."""
-        subprocess.run(["/usr/bin/open", self.datadir], check=True)
+        _open(self.datadir)
 
     def open_workflowdir(self):
         """Open the workflow's :attr:`workflowdir` in Finder."""
-        subprocess.run(["/usr/bin/open", self.workflowdir], check=True)
+        _open(self.workflowdir)
 
     def open_terminal(self):
         """Open a Terminal window at workflow's :attr:`workflowdir`."""
-        subprocess.run(
-            ["/usr/bin/open", "-a", "Terminal", self.workflowdir], check=True
-        )
+        _open("-a", "Terminal", self.workflowdir)
 
     def open_help(self):
         """Open :attr:`help_url` in default browser."""
-        subprocess.run(["/usr/bin/open", self.help_url], check=True)
+        _open(self.help_url)
 
         return "Opening workflow help URL in browser"
 
@@ -3080,6 +3414,8 @@ class Workflow:
                 path = os.path.join(dirpath, filename)
 
                 if os.path.isdir(path):
+                    import shutil
+
                     shutil.rmtree(path)
                 else:
                     os.unlink(path)
@@ -3089,6 +3425,8 @@ class Workflow:
     def _load_info_plist(self):
         """Load workflow info from ``info.plist``."""
         # info.plist should be in the directory above this one
+        import plistlib
+
         with open(self.workflowfile("info.plist"), "rb") as file_obj:
             self._info = plistlib.load(file_obj)
         self._info_loaded = True
@@ -3127,6 +3465,8 @@ class Workflow:
         :returns: Data from stdout.
         :rtype: ``str``
         """
+        import subprocess
+
         cmd = ["security", action, "-s", service, "-a", account] + list(args)
         with subprocess.Popen(
             cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT